@@ -67,6 +67,9 @@ only_organized = False
 order_field = ["$video_codec", "$audio_codec", "$resolution", "$height", "$studio_family", "$studio", "$parent_studio","$performer"]
 # Alternate way to show diff. Not useful at all.
 alt_diff_display = False
+# at the end of a task, the time spent in each phase (graphql, template, render, duplicate check, file move, database) and the bytes moved are in the log.
+# Full path of a JSON file to also save it there (e.g. r"C:\Users\USERNAME\.stash\plugins\renamer_timing.json"). Leave blank ("") for the log only.
+timing_report_file = r""
 
 ######################################
 #            Module Related          #
@@ -74,7 +77,8 @@ alt_diff_display = False
 # ! OPTIONAL module settings. Not needed for basic operation !
 
 # = psutil module (https://pypi.org/project/psutil/) =
-# Gets a list of all processes instead of stopping after the first one. Enabling it slows down the plugin
+# On Linux, only a busy file (EBUSY, e.g. a file bind-mounted in a container) blocks a rename.
+# Gets a list of all processes instead of stopping after the first one. Enabling it slows down the plugin (except on Linux, where the open files are read from /proc)
 process_getall = False
 # If the file is used by a process, the plugin will kill it. IT CAN MAKE STASH CRASH TOO. 
 process_kill_attach = False
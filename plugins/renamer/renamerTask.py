@@ -1,8 +1,11 @@
 import difflib
+import errno
+import functools
 import json
 import os
 import re
 import sqlite3
+import stat
 import subprocess
 import sys
 import time
@@ -23,12 +26,16 @@ except:
 
 import config
 import log
+from phase_timer import PhaseTimer
+from template_compiler import compile_template
 
 
 FRAGMENT = json.loads(sys.stdin.read())
 FRAGMENT_SERVER = FRAGMENT["server_connection"]
 PLUGIN_DIR = FRAGMENT_SERVER["PluginDir"]
 PLUGIN_ARGS = FRAGMENT['args'].get("mode")
+# per-phase timings, in the log at the end (see phase_timer)
+TIMER = PhaseTimer()
 
 log.LogDebug("--Starting Plugin 'Renammer'--")
 
@@ -56,7 +63,8 @@ def callGraphQL(query, variables=None, raise_exception=True):
     if variables is not None:
         json['variables'] = variables
     try:
-        response = requests.post(graphql_url, json=json,headers=graphql_headers, cookies=graphql_cookies, timeout=20)
+        with TIMER.phase("graphql"):
+            response = requests.post(graphql_url, json=json,headers=graphql_headers, cookies=graphql_cookies, timeout=20)
     except Exception as e:
          exit_plugin(err="[FATAL] Exception with GraphQL request. {}".format(e))
     if response.status_code == 200:
@@ -83,106 +91,7 @@ def graphql_getScene(scene_id):
             ...SceneData
         }
     }
-    fragment SceneData on Scene {
-        id
-        checksum
-        oshash
-        title
-        details
-        url
-        date
-        rating
-        o_counter
-        organized
-        path
-        phash
-        interactive
-        file {
-            size
-            duration
-            video_codec
-            audio_codec
-            width
-            height
-            framerate
-            bitrate
-        }
-        studio {
-            ...SlimStudioData
-        }
-        movies {
-            movie {
-            ...MovieData
-            }
-            scene_index
-        }
-        tags {
-            ...SlimTagData
-        }
-        performers {
-            ...PerformerData
-        }
-    }
-    fragment SlimStudioData on Studio {
-        id
-        name
-        parent_studio {
-            id
-            name
-        }
-        details
-        rating
-        aliases
-    }
-    fragment MovieData on Movie {
-        id
-        checksum
-        name
-        aliases
-        date
-        rating
-        director
-        studio {
-            ...SlimStudioData
-        }
-        synopsis
-        url
-    }
-    fragment SlimTagData on Tag {
-        id
-        name
-        aliases
-    }
-    fragment PerformerData on Performer {
-        id
-        checksum
-        name
-        url
-        gender
-        twitter
-        instagram
-        birthdate
-        ethnicity
-        country
-        eye_color
-        height
-        measurements
-        fake_tits
-        career_length
-        tattoos
-        piercings
-        aliases
-        favorite
-        tags {
-            ...SlimTagData
-        }
-        rating
-        details
-        death_date
-        hair_color
-        weight
-    }
-    """
+    """ + scene_fragment(tuple(configured_templates()))
     variables = {
         "id": scene_id
     }
@@ -190,6 +99,31 @@ def graphql_getScene(scene_id):
     return result.get('findScene')
 
 
+def configured_templates():
+    templates = list(config.tag_templates.values()) + list(config.studio_templates.values())
+    if config.use_default_template:
+        templates.append(config.default_template)
+    return templates
+
+
+@functools.lru_cache(maxsize=None)
+def scene_fragment(templates):
+    # Only ask Stash for the objects used by the templates (resolving all the performer data is slow)
+    selections = set()
+    for template in templates:
+        for name in compile_template(template, TEMPLATE_FIELD).fields:
+            selections.update(SCENE_FIELD_SELECTIONS.get(name, ()))
+    if config.tag_templates:
+        selections.add("tags")
+    if config.studio_templates:
+        selections.add("studio")
+    lines = ["id", "title", "date", "organized", "path"]
+    for name, selection in SCENE_SELECTIONS.items():
+        if name in selections:
+            lines.append(selection)
+    return "fragment SceneData on Scene {\n" + "".join("        {}\n".format(line) for line in lines) + "    }"
+
+
 def graphql_getConfiguration():
     query = """
         query Configuration {
@@ -268,27 +202,26 @@ def graphql_findScene(perPage,direc="DESC"):
 
 
 def makeFilename(scene_information, query):
-    new_filename = str(query)
-    for field in TEMPLATE_FIELD:
-        field_name = field.replace("$","")
-        if field in new_filename:
-            if scene_information.get(field_name):
-                if field == "$performer":
-                    if re.search(r"\$performer[-\s_]*\$title", new_filename) and scene_information.get('title') and PREVENT_TITLE_PERF:
-                        if re.search("^{}".format(scene_information["performer"]), scene_information["title"]):
-                            log.LogInfo("Ignoring the performer field because it's already in start of title")
-                            new_filename = re.sub('\$performer[-\s_]*', '', new_filename)
-                            continue
-                new_filename = new_filename.replace(field, scene_information[field_name])
-            else:
-                new_filename = re.sub('\${}[-\s_]*'.format(field_name), '', new_filename)
+    template = compile_template(query, TEMPLATE_FIELD, groups=False, strip_after=r"[-\s_]*")
+    ignore_performer = False
+    if template.performer_before_title and scene_information.get('title') and scene_information.get('performer') and PREVENT_TITLE_PERF:
+        if scene_information["title"].startswith(scene_information["performer"]):
+            log.LogInfo("Ignoring the performer field because it's already in start of title")
+            ignore_performer = True
+
+    def lookup(field_name):
+        if field_name == "performer" and ignore_performer:
+            return None
+        return scene_information.get(field_name)
+
+    new_filename = template.render(lookup)
 
     # remove []
-    new_filename = re.sub('\[\W*]', '', new_filename)
+    new_filename = EMPTY_BRACKET_RE.sub('', new_filename)
     # Remove multiple space/_ in row
-    new_filename = re.sub('[\s_]{2,}', ' ', new_filename)
+    new_filename = MULTI_SPACE_RE.sub(' ', new_filename)
     # Remove multiple - in row
-    new_filename = re.sub('(?:[\s_]-){2,}', ' -', new_filename)
+    new_filename = MULTI_DASH_RE.sub(' -', new_filename)
     # Remove space at start/end
     new_filename = new_filename.strip(" -")
     return new_filename
@@ -317,7 +250,64 @@ def find_diff_text(a, b):
     return 
 
 
-def has_handle(fpath,all_result=False):
+def proc_open_files(pids=None):
+    # {(device, inode): {pid}} of the regular files opened by the processes, read from /proc.
+    # A single pass over /proc/*/fd, instead of asking every process for its list of files.
+    handles = {}
+    if pids is None:
+        pids = [int(pid) for pid in os.listdir("/proc") if pid.isdigit()]
+    for pid in pids:
+        fd_dir = "/proc/{}/fd".format(pid)
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                fd_stat = os.stat(os.path.join(fd_dir, fd))
+            except OSError:
+                continue
+            if stat.S_ISREG(fd_stat.st_mode):
+                handles.setdefault((fd_stat.st_dev, fd_stat.st_ino), set()).add(pid)
+    return handles
+
+
+def proc_handle_pids(fpath, fresh=False):
+    # The scan of /proc is kept for the whole run (bulk task), the processes found in it are
+    # checked again. fresh: scan /proc again first (the file was found busy).
+    global PROC_HANDLES
+    file_stat = os.stat(fpath)
+    key = (file_stat.st_dev, file_stat.st_ino)
+    if fresh or PROC_HANDLES is None:
+        PROC_HANDLES = proc_open_files()
+    return sorted(pid for pid in PROC_HANDLES.get(key, ()) if key in proc_open_files([pid]))
+
+
+def file_busy(err):
+    # The file is used by another process: sharing violation (Windows), busy (Linux, a bind mount...)
+    return "[WinError 32]" in str(err) or err.errno in (errno.EBUSY, errno.ETXTBSY)
+
+
+def has_handle(fpath, all_result=False):
+    if not os.path.isdir("/proc/self/fd"):
+        return psutil_handle(fpath, all_result)
+    lst = []
+    try:
+        pids = proc_handle_pids(fpath, fresh=True)
+    except OSError:
+        pids = []
+    for pid in pids:
+        try:
+            proc = psutil.Process(pid)
+        except psutil.NoSuchProcess:
+            continue
+        if not all_result:
+            return proc
+        lst.append(proc)
+    return lst
+
+
+def psutil_handle(fpath, all_result=False):
     lst = []
     for proc in psutil.process_iter():
         try:
@@ -343,6 +333,7 @@ def exit_plugin(msg=None, err=None):
 def renamer(scene_id):
     filename_template = None
     STASH_SCENE = graphql_getScene(scene_id)
+    template_start = time.perf_counter()
     # ================================================================ #
     #                       RENAMER                                    #
     # Tags > Studios > Default
@@ -369,6 +360,7 @@ def renamer(scene_id):
 
     #                           END                                    #
     ####################################################################
+    TIMER.add("template", time.perf_counter() - template_start)
 
     if config.only_organized and not STASH_SCENE["organized"]:
         return("Scene ignored (not organized)")
@@ -378,6 +370,7 @@ def renamer(scene_id):
 
     #log.LogDebug("Using this template: {}".format(filename_template))
 
+    render_start = time.perf_counter()
     current_path = STASH_SCENE["path"]
     # note: contain the dot (.mp4)
     file_extension = os.path.splitext(current_path)[1]
@@ -431,22 +424,24 @@ def renamer(scene_id):
             scene_information["parent_studio"] = STASH_SCENE["studio"]["parent_studio"]["name"]
             scene_information["studio_family"] = scene_information["parent_studio"]
 
-    # Grab Height (720p,1080p,4k...)
-    scene_information["resolution"] = 'SD'
-    scene_information["height"] = "{}p".format(STASH_SCENE["file"]["height"])
-    if STASH_SCENE["file"]["height"] >= 720:
-        scene_information["resolution"] = 'HD'
-    if STASH_SCENE["file"]["height"] >= 2160:
-        scene_information["height"] = '4k'
-        scene_information["resolution"] = 'UHD'
-    if STASH_SCENE["file"]["height"] >= 4320:
-        scene_information["height"] = '8k'
-    # For Phone ?
-    if STASH_SCENE["file"]["height"] > STASH_SCENE["file"]["width"]:
-        scene_information["resolution"] = 'VERTICAL'
-
-    scene_information["video_codec"] = STASH_SCENE["file"]["video_codec"]
-    scene_information["audio_codec"] = STASH_SCENE["file"]["audio_codec"]
+    # file fields, only asked to Stash if a template uses them
+    if STASH_SCENE.get("file"):
+        # Grab Height (720p,1080p,4k...)
+        scene_information["resolution"] = 'SD'
+        scene_information["height"] = "{}p".format(STASH_SCENE["file"]["height"])
+        if STASH_SCENE["file"]["height"] >= 720:
+            scene_information["resolution"] = 'HD'
+        if STASH_SCENE["file"]["height"] >= 2160:
+            scene_information["height"] = '4k'
+            scene_information["resolution"] = 'UHD'
+        if STASH_SCENE["file"]["height"] >= 4320:
+            scene_information["height"] = '8k'
+        # For Phone ?
+        if STASH_SCENE["file"]["height"] > STASH_SCENE["file"]["width"]:
+            scene_information["resolution"] = 'VERTICAL'
+
+        scene_information["video_codec"] = STASH_SCENE["file"]["video_codec"]
+        scene_information["audio_codec"] = STASH_SCENE["file"]["audio_codec"]
 
     log.LogDebug("[{}] Scene information: {}".format(scene_id,scene_information))
 
@@ -486,6 +481,7 @@ def renamer(scene_id):
                 break
         if len(new_path) > 240:
             return("Can't manage to reduce the path, operation aborted.")
+    TIMER.add("render", time.perf_counter() - render_start)
 
     #log.LogDebug("Filename: {} -> {}".format(current_filename,new_filename))
     #log.LogDebug("Path: {} -> {}".format(current_path,new_path))
@@ -501,8 +497,17 @@ def renamer(scene_id):
     if DRY_RUN:
         with open(FILE_DRYRUN_RESULT, 'a', encoding='utf-8') as f:
             f.write("{}|{}|{}\n".format(scene_id, current_filename, new_filename))
+        # Used by the Process_dry task, so it doesn't need to check the scenes again.
+        with open(FILE_DRYRUN_PLAN, 'a', encoding='utf-8') as f:
+            plan_entry = {"scene_id": scene_id, "old_path": current_path, "new_path": new_path, "template": filename_template}
+            f.write(json.dumps(plan_entry, ensure_ascii=False) + "\n")
         return("[Dry-run] Writing in {}".format(FILE_DRYRUN_RESULT))
 
+    return apply_rename(scene_id, current_path, new_path)
+
+
+def apply_rename(scene_id, current_path, new_path):
+    new_filename = os.path.basename(new_path)
 
     # Connect to the DB
     try:
@@ -512,58 +517,72 @@ def renamer(scene_id):
     except sqlite3.Error as error:
         return("FATAL SQLITE Error: {}".format(error))
 
+    # The scene may have been moved since the dry-run
+    cursor.execute("SELECT path FROM scenes WHERE id=?;", [scene_id])
+    row = cursor.fetchone()
+    if row is None or row[0] != current_path:
+        log.LogWarning("[{}] The path has changed since the dry-run, skipped. ({})".format(scene_id, current_path))
+        sqliteConnection.close()
+        return ""
+
     # Looking for duplicate filename
-    folder_name = os.path.basename(os.path.dirname(new_path))
-    cursor.execute("SELECT id FROM scenes WHERE path LIKE ? AND NOT id=?;", ["%" + folder_name + "_" + new_filename, scene_id])
-    dupl_check = cursor.fetchall()
-    if len(dupl_check) > 0:
-        for dupl_row in dupl_check:
-            log.LogError("Same path: [{}]".format(dupl_row[0]))
-        return("Duplicate path detected, check log!")
-
-    cursor.execute("SELECT id FROM scenes WHERE path LIKE ? AND NOT id=?;", ["%" + new_filename, scene_id])
-    dupl_check = cursor.fetchall()
-    if len(dupl_check) > 0:
-        for dupl_row in dupl_check:
-            log.LogInfo("Same filename: [{}]".format(dupl_row[0]))
+    with TIMER.phase("duplicate check"):
+        folder_name = os.path.basename(os.path.dirname(new_path))
+        cursor.execute("SELECT id FROM scenes WHERE path LIKE ? AND NOT id=?;", ["%" + folder_name + "_" + new_filename, scene_id])
+        dupl_check = cursor.fetchall()
+        if len(dupl_check) > 0:
+            for dupl_row in dupl_check:
+                log.LogError("Same path: [{}]".format(dupl_row[0]))
+            return("Duplicate path detected, check log!")
+
+        cursor.execute("SELECT id FROM scenes WHERE path LIKE ? AND NOT id=?;", ["%" + new_filename, scene_id])
+        dupl_check = cursor.fetchall()
+        if len(dupl_check) > 0:
+            for dupl_row in dupl_check:
+                log.LogInfo("Same filename: [{}]".format(dupl_row[0]))
 
     # OS Rename
-    if (os.path.isfile(current_path) == True):
-        try:
-            os.rename(current_path, new_path)
-        except PermissionError as err:
-            if "[WinError 32]" in str(err) and MODULE_PSUTIL:
-                log.LogWarning("A process use this file, trying to find it (Probably FFMPEG)")
-                # Find what process access the file, it's ffmpeg for sure...
-                process_use = has_handle(current_path, PROCESS_ALLRESULT)
-                if process_use:
-                    # Terminate the process then try again to rename
-                    log.LogDebug("Process that use this file: {}".format(process_use))
-                    if PROCESS_KILL:
-                        p = psutil.Process(process_use.pid)
-                        p.terminate()
-                        p.wait(10)
-                        # If we don't manage to close it, this will create a error again.
-                        os.rename(current_path, new_path)
-                    else:
-                        return("A process prevent editing the file.")
+    with TIMER.phase("file move"):
+        if (os.path.isfile(current_path) == True):
+            try:
+                os.rename(current_path, new_path)
+            except OSError as err:
+                if not file_busy(err) and not isinstance(err, PermissionError):
+                    raise
+                if file_busy(err) and MODULE_PSUTIL:
+                    log.LogWarning("A process use this file, trying to find it (Probably FFMPEG)")
+                    # Find what process access the file, it's ffmpeg for sure...
+                    process_use = has_handle(current_path, PROCESS_ALLRESULT)
+                    if process_use:
+                        # Terminate the process then try again to rename
+                        log.LogDebug("Process that use this file: {}".format(process_use))
+                        if PROCESS_KILL:
+                            for p in (process_use if isinstance(process_use, list) else [process_use]):
+                                p.terminate()
+                                p.wait(10)
+                            # If we don't manage to close it, this will create a error again.
+                            os.rename(current_path, new_path)
+                        else:
+                            return("A process prevent editing the file.")
+                else:
+                    log.LogError(err)
+                    return ""
+            if (os.path.isfile(new_path) == True):
+                log.LogInfo("[OS] File Renamed!")
+                TIMER.count("bytes moved", os.path.getsize(new_path))
+                if LOGFILE:
+                    with open(LOGFILE, 'a', encoding='utf-8') as f:
+                        f.write("{}|{}|{}\n".format(scene_id, current_path, new_path))
             else:
-                log.LogError(err)
-                return ""
-        if (os.path.isfile(new_path) == True):
-            log.LogInfo("[OS] File Renamed!")
-            if LOGFILE:
-                with open(LOGFILE, 'a', encoding='utf-8') as f:
-                    f.write("{}|{}|{}\n".format(scene_id, current_path, new_path))
+                # I don't think it's possible. 
+                return("[OS] File failed to rename ? {}".format(new_path))
         else:
-            # I don't think it's possible. 
-            return("[OS] File failed to rename ? {}".format(new_path))
-    else:
-        return("[OS] File don't exist in your Disk/Drive ({})".format(current_path))
+            return("[OS] File don't exist in your Disk/Drive ({})".format(current_path))
 
     # Database rename
-    cursor.execute("UPDATE scenes SET path=? WHERE id=?;", [new_path, scene_id])
-    sqliteConnection.commit()
+    with TIMER.phase("database"):
+        cursor.execute("UPDATE scenes SET path=? WHERE id=?;", [new_path, scene_id])
+        sqliteConnection.commit()
     # Close DB
     cursor.close()
     sqliteConnection.close()
@@ -573,10 +592,34 @@ def renamer(scene_id):
 
 # File that show what we will changed.
 FILE_DRYRUN_RESULT = os.path.join(PLUGIN_DIR, "renamer_scan.txt")
+# Same changes as JSON lines (scene_id, old_path, new_path, template), read by Process_dry.
+FILE_DRYRUN_PLAN = os.path.join(PLUGIN_DIR, "renamer_plan.jsonl")
 
 STASH_CONFIG = graphql_getConfiguration()
 STASH_DATABASE = STASH_CONFIG["general"]["databasePath"]
-TEMPLATE_FIELD = "$date $year $performer $title $height $resolution $studio $parent_studio $studio_family $video_codec $audio_codec".split(" ")
+TEMPLATE_FIELD = tuple("$date $year $performer $title $height $resolution $studio $parent_studio $studio_family $video_codec $audio_codec".split(" "))
+
+# objects of the scene needed by each template field
+SCENE_FIELD_SELECTIONS = {
+    "performer": ("performers",),
+    "studio": ("studio",),
+    "parent_studio": ("studio",),
+    "studio_family": ("studio",),
+    "height": ("file",),
+    "resolution": ("file",),
+    "video_codec": ("file",),
+    "audio_codec": ("file",)
+}
+SCENE_SELECTIONS = {
+    "file": "file { video_codec audio_codec width height }",
+    "studio": "studio { id name parent_studio { id name } }",
+    "tags": "tags { id name }",
+    "performers": "performers { id name gender }"
+}
+
+EMPTY_BRACKET_RE = re.compile(r'\[\W*]')
+MULTI_SPACE_RE = re.compile(r'[\s_]{2,}')
+MULTI_DASH_RE = re.compile(r'(?:[\s_]-){2,}')
 
 # READING CONFIG
 
@@ -588,6 +631,8 @@ PREVENT_TITLE_PERF = config.prevent_title_performer
 
 PROCESS_KILL = config.process_kill_attach
 PROCESS_ALLRESULT = config.process_getall
+# open files of the processes, see has_handle
+PROC_HANDLES = None
 UNICODE_USE = config.use_ascii
 
 ORDER_SHORTFIELD = config.order_field
@@ -603,36 +648,48 @@ if PLUGIN_ARGS in ["Process_test","Process_full","Process_dry"]:
 else:
     log.LogDebug("Dry-Run enable")
     DRY_RUN = True
+    # only the changes of this dry-run
+    open(FILE_DRYRUN_PLAN, 'w', encoding='utf-8').close()
 
 if PLUGIN_ARGS in ["DRYRUN_test","Process_test"]:
     scenes = graphql_findScene(10, "DESC")
 if PLUGIN_ARGS in ["DRYRUN_full","Process_full"]:
     scenes = graphql_findScene(-1, "ASC")
 if PLUGIN_ARGS == "Process_dry":
-    if os.path.exists(FILE_DRYRUN_RESULT):
+    if os.path.exists(FILE_DRYRUN_PLAN):
         scenes = {"scenes":[]}
-        with open(FILE_DRYRUN_RESULT, 'r', encoding='utf-8') as f:
+        with open(FILE_DRYRUN_PLAN, 'r', encoding='utf-8') as f:
             for line in f:
-                scene_id_file = line.split("|")[0]
-                scenes["scenes"].append({"id": scene_id_file})
+                if line.strip():
+                    scenes["scenes"].append(json.loads(line))
     else:
-        exit_plugin(err="Can't find the file from the dry-run ({}). Be sure to run a Dry-Run task before.".format(FILE_DRYRUN_RESULT))
+        exit_plugin(err="Can't find the file from the dry-run ({}). Be sure to run a Dry-Run task before.".format(FILE_DRYRUN_PLAN))
 
 if not scenes:
     exit_plugin(err="no scene")
+if not scenes["scenes"]:
+    # the last dry-run found nothing to rename
+    exit_plugin("No change to process")
 
 log.LogDebug("Count scenes: {}".format(len(scenes["scenes"])))
 progress_step = 1 / len(scenes["scenes"])
 
 for scene in scenes["scenes"]:
-    msg = renamer(scene["id"])
+    TIMER.count("scenes")
+    if PLUGIN_ARGS == "Process_dry":
+        # the new path comes from the dry-run, no need to ask Stash again
+        msg = apply_rename(scene["scene_id"], scene["old_path"], scene["new_path"])
+    else:
+        msg = renamer(scene["id"])
     if msg:
         log.LogDebug(msg)
     progress += progress_step
     log.LogProgress(progress)
 
 if PLUGIN_ARGS == "Process_dry":
-    os.remove(FILE_DRYRUN_RESULT)
+    os.remove(FILE_DRYRUN_PLAN)
+    if os.path.exists(FILE_DRYRUN_RESULT):
+        os.remove(FILE_DRYRUN_RESULT)
 
 if DRY_RUN:
     num_lines = 0
@@ -643,5 +700,6 @@ if DRY_RUN:
     else:
         log.LogInfo("[DRY-RUN] No change to do.")
 
+TIMER.report(TIMER.counters.get("scenes"), config.timing_report_file)
 log.LogInfo("Took {} seconds".format(round(time.time() - start_time)))
 exit_plugin("Successful!")
@@ -0,0 +1,124 @@
+import functools
+import re
+
+# Template compiler shared by the renamer scripts.
+#
+# A template like "[$studio] {$date -} $title" is parsed once into a list of
+# segments (literal text, fields and {} groups). Rendering a scene only walks
+# that list, so no regex is run on the template string per field/per scene.
+# Compiled templates are cached per template string.
+
+LITERAL = 0
+FIELD = 1
+GROUP = 2
+
+GROUP_RE = re.compile(r"\{([^{}]*)\}")
+PERFORMER_TITLE_RE = re.compile(r"\$performer[-\s_]*\$title")
+
+
+class Template:
+    def __init__(self, source: str, segments: list):
+        self.source = source
+        self.segments = segments
+        # field names (without $) used by the template, in order of appearance
+        self.fields = []
+        for seg in segments:
+            for name in _segment_fields(seg):
+                if name not in self.fields:
+                    self.fields.append(name)
+        # '$performer - $title', used by the prevent_title_performer option
+        self.performer_before_title = bool(PERFORMER_TITLE_RE.search(source))
+
+    def render(self, lookup, keep_braces=False) -> str:
+        # lookup(field_name) returns the value of the field, or None/"" if empty.
+        # An empty field is removed with its trailing separator (if compiled
+        # with strip_after) or with the whole group it belongs to.
+        # keep_braces: a kept group is rendered with its braces, for the
+        # renamers that remove them in their own cleanup step.
+        out = []
+        for seg in self.segments:
+            if seg[0] == LITERAL:
+                out.append(seg[1])
+            elif seg[0] == FIELD:
+                value = lookup(seg[1])
+                if value:
+                    out.append(value)
+                    out.append(seg[2])
+            else:
+                group = _render_group(seg[1], lookup)
+                if group is not None:
+                    if keep_braces:
+                        group = "{" + group + "}"
+                    out.append(group)
+        return "".join(out)
+
+    def __repr__(self):
+        return f"Template({self.source!r})"
+
+
+def _segment_fields(seg):
+    if seg[0] == FIELD:
+        return [seg[1]]
+    if seg[0] == GROUP:
+        return [s[1] for s in seg[1] if s[0] == FIELD]
+    return []
+
+
+def _render_group(segments: list, lookup):
+    out = []
+    for seg in segments:
+        if seg[0] == LITERAL:
+            out.append(seg[1])
+        else:
+            value = lookup(seg[1])
+            if not value:
+                return None
+            out.append(value)
+            out.append(seg[2])
+    return "".join(out)
+
+
+@functools.lru_cache(maxsize=None)
+def _field_regex(fields: tuple):
+    # longest name first so $performer_path wins over $performer
+    names = sorted((f.lstrip("$") for f in fields), key=len, reverse=True)
+    return re.compile(r"\$(" + "|".join(re.escape(n) for n in names) + ")")
+
+
+def _parse_text(text: str, field_re, strip_re) -> list:
+    segments = []
+    pos = 0
+    for match in field_re.finditer(text):
+        if match.start() > pos:
+            segments.append((LITERAL, text[pos:match.start()]))
+        pos = match.end()
+        tail = ""
+        if strip_re:
+            tail = strip_re.match(text, pos).group(0)
+            pos += len(tail)
+        segments.append((FIELD, match.group(1), tail))
+    if pos < len(text):
+        segments.append((LITERAL, text[pos:]))
+    return segments
+
+
+@functools.lru_cache(maxsize=None)
+def compile_template(source: str, fields: tuple, groups=True, strip_after=None) -> Template:
+    # fields: available fields ("$date", "$title", ...)
+    # groups: handle {} groups, else braces are kept as text
+    # strip_after: regex of the separator removed after an empty field (ex: r"[-\s_]*")
+    field_re = _field_regex(fields)
+    strip_re = re.compile(strip_after) if strip_after else None
+    segments = []
+    pos = 0
+    if groups:
+        for match in GROUP_RE.finditer(source):
+            segments.extend(_parse_text(source[pos:match.start()], field_re, strip_re))
+            group = _parse_text(match.group(1), field_re, strip_re)
+            if any(seg[0] == FIELD for seg in group):
+                segments.append((GROUP, group))
+            else:
+                segments.append((LITERAL, match.group(0)))
+            pos = match.end()
+    segments.extend(_parse_text(source[pos:], field_re, strip_re))
+    return Template(source, segments)
@@ -116,6 +116,9 @@ log_file = r""
 
 # rename associated file (subtitle, funscript) if present
 associated_extension = ["srt", "vtt", "funscript"]
+# other associated files, what follows the name of the video (* = anything). ex: video.mp4 -> video.en.srt, video-thumb.jpg
+# Not used if associated_extension is empty (no associated file is moved)
+associated_patterns = [".*.srt", ".*.vtt", "-thumb.jpg"]
 
 # Character which replaces every space in the filename
 # Common values are "." and "_"
@@ -126,7 +129,7 @@ filename_splitchar = " "
 
 # replace space for stash field (title, performer...), if you have a title 'I love Stash' it can become 'I_love_Stash'
 field_whitespaceSeperator = ""
-# Remove/Replace character from field (not using regex)
+# Remove/Replace character from field (not using regex), only in the value of that field (not in the rest of the filename/path)
 # "field": {"replace": "foo","with": "bar"}
 # ex: "$studio": {"replace": "'","with": ""} My Dad's Hot Girlfriend --> My Dads Hot Girlfriend
 field_replacer = {
@@ -138,6 +141,9 @@ field_replacer = {
 # difference between 'word' & 'any': word is between seperator (space, _, -), any is anything ('ring' would replace 'during')
 # ex:   "Scene": ["Sc.", "word"]    - Replace Scene by Sc.
 #       r"S\d+:E\d+": ["", "regex"] - Remove Sxx:Ex (x is a digit)
+# The rules are applied in this order. Consecutive 'word' (or 'any') rules are checked together, in one pass on the same text:
+# they don't see each other's result, and if two of them match at the same place, the first one is used.
+# The 'regex' rules and the 'word' rules with a group in parentheses (\1 in the replacement) are applied alone, on the result of the previous rules.
 replace_words = {
 }
 
@@ -168,8 +174,17 @@ prevent_title_performer = False
 ## Path mover related
 # remove consecutive (/FolderName/FolderName/video.mp4 -> FolderName/video.mp4
 prevent_consecutive = True
-# check when the file has moved that the old directory is empty, if empty it will remove it.
+# check when the file has moved that the old directory is empty, if empty it will remove it (and its parents that became empty, up to the library folder).
+# The tasks check the folders once, at the end.
 remove_emptyfolder = True
+# moving a file to another drive copies it by chunks of X MiB. An interrupted copy is kept (.part) and resumed on the next run.
+copy_chunk_size = 8
+# number of moves done at the same time by the tasks, each one on different drives (source and destination).
+# The moves using the same drive are always done one by one, in order. 1 = every move one by one, in order.
+move_workers = 1
+# save each move in a journal (renamerOnUpdate_journal.db) before doing it. If the plugin is killed during a move, the next run finishes or cancels it.
+# Needed by the 'Undo last task' task.
+rename_journal = True
 # the folder only contains 1 performer name. Else it will look the same as for filename
 path_one_performer = True
 # if there is no performer on the scene, the $performer field will be replaced by "NoPerformer" so a folder "NoPerformer" will be created
@@ -225,9 +240,37 @@ alt_diff_display = False
 
 # number of scene process by the task renamer. -1 = all scenes
 batch_number_scene = -1
+# number of scenes requested at once by the task renamer. -1 = all scenes in one request (uses a lot of memory for big library)
+batch_per_page = 500
+# order used to go through the scenes: "id" or "updated_at". "id" is stable if scenes are edited while the task runs.
+# Always "id" when the task only asks for the scenes of the templates (batch_prefilter).
+batch_sort = "id"
+# number of workers computing the new paths in parallel for the task renamer (files are still moved one by one, in order).
+# 1 = no worker, 0 = number of CPU
+batch_workers = 1
+# the task renamer only asks Stash for the scenes that can use a template (organized, tags/studios/paths of the templates).
+# Set to False if your version of Stash refuses the filter: the task then asks for the scenes by page number instead of "after the last id".
+batch_prefilter = True
+# the task renamer saves the new paths in the database by batch: every X scenes or every X seconds.
+# Bigger batches are faster, but the database is locked for Stash until the batch is saved.
+db_batch_size = 100
+db_batch_interval = 5
+# if Stash has locked the database (scan, generate...), the moved files are kept in a queue and saved when it's free (they are not moved back).
+# Seconds to wait for it at the end of a task or for a hook. After that, the next run saves them (rename_journal).
+db_busy_timeout = 300
+# Same for a hook (Stash waits for it), when the journal can save the path later (rename_journal). Without journal, db_busy_timeout is used.
+db_busy_timeout_hook = 5
+
+# at the end of a task, the time spent in each phase (graphql, template, render, duplicate check, file move, database...) and the bytes moved are in the log.
+# Full path of a JSON file to also save it there (e.g. r"C:\Users\USERNAME\.stash\plugins\renamer_timing.json"). Leave blank ("") for the log only.
+timing_report_file = r""
 
 # disable/enable the hook. You can edit this value in 'Plugin Tasks' inside of Stash.
 enable_hook = True
+# keep a worker running in the background for the hook (Linux/macOS), so a scene update doesn't start the whole plugin again.
+# Useful when you edit many scenes at once. The worker stops after hook_daemon_idle seconds without update, or when config.py is edited.
+hook_daemon = False
+hook_daemon_idle = 600
 # disable/enable dry mode. Do a trial run with no permanent changes. Can write into a file (dryrun_renamerOnUpdate.txt), set a path for log_file. 
 # You can edit this value in 'Plugin Tasks' inside of Stash.
 dry_run = False
@@ -237,7 +280,8 @@ dry_run = False
 # ! OPTIONAL module settings. Not needed for basic operation !
 
 # = psutil module (https://pypi.org/project/psutil/) =
-# Gets a list of all processes instead of stopping after the first one. Enabling it slows down the plugin
+# On Linux, a file is in use when a process is writing it and it's moved to another drive (a rename isn't blocked by an open file).
+# Gets a list of all processes instead of stopping after the first one. Enabling it slows down the plugin (except on Linux, where the open files are read from /proc)
 process_getall = False
 # If the file is used by a process, the plugin will kill it. IT CAN MAKE STASH CRASH TOO. 
 process_kill_attach = False
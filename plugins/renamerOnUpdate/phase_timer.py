@@ -0,0 +1,108 @@
+import array
+import contextlib
+import json
+import time
+
+import log
+
+# Per-phase timings of a renamer run, shared by the renamer scripts.
+#
+# Each phase (GraphQL, template, render, file move, database...) keeps the
+# duration of every call, the summary gives count/total/p50/p95/max per phase
+# and the counters (bytes moved...). It tells if a slow run waits on Stash,
+# on the database or on the disk.
+
+
+class PhaseTimer:
+    def __init__(self):
+        self.start = time.time()
+        # phase -> durations in seconds (array of doubles, 8 bytes per call)
+        self.samples = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = array.array('d')
+        samples.append(seconds)
+
+    def count(self, name: str, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def take(self):
+        # Samples and counters recorded since the last take, to merge them in another timer
+        # (a worker process or thread).
+        data = ({name: samples.tobytes() for name, samples in self.samples.items()}, self.counters)
+        self.samples, self.counters = {}, {}
+        return data
+
+    def merge(self, data):
+        samples, counters = data
+        for name, raw in samples.items():
+            self.samples.setdefault(name, array.array('d')).frombytes(raw)
+        for name, value in counters.items():
+            self.count(name, value)
+
+    def summary(self, items=None) -> dict:
+        # items: number of scenes of the run, for the throughput
+        elapsed = time.time() - self.start
+        phases = {}
+        for name, samples in self.samples.items():
+            ordered = sorted(samples)
+            phases[name] = {
+                "count": len(ordered),
+                "total": sum(ordered),
+                "p50": _percentile(ordered, 50),
+                "p95": _percentile(ordered, 95),
+                "max": ordered[-1]
+            }
+        report = {"elapsed": elapsed, "phases": phases, "counters": dict(self.counters)}
+        if items:
+            report["items"] = items
+            report["items_per_second"] = items / elapsed if elapsed else None
+        return report
+
+    def report(self, items=None, json_path=None, level=log.LogInfo):
+        # Summary in the log, and in json_path if given. Nothing if nothing was timed.
+        if not self.samples and not self.counters:
+            return
+        report = self.summary(items)
+        for name, phase in sorted(report["phases"].items(), key=lambda x: -x[1]["total"]):
+            level(f"[TIMING] {name}: {phase['count']} call(s), total {_duration(phase['total'])}, "
+                  f"p50 {_duration(phase['p50'])}, p95 {_duration(phase['p95'])}, max {_duration(phase['max'])}")
+        for name, value in sorted(report["counters"].items()):
+            level(f"[TIMING] {name}: {_size(value) if name.startswith('bytes') else value}")
+        if items:
+            level(f"[TIMING] {items} scene(s) in {_duration(report['elapsed'])} ({report['items_per_second']:.1f}/s)")
+        if json_path:
+            try:
+                with open(json_path, 'w', encoding='utf-8') as f:
+                    json.dump(report, f, indent=2)
+            except OSError as err:
+                log.LogWarning(f"Can't write the timing report ({json_path}): {err}")
+
+
+def _percentile(ordered, percent):
+    # nearest rank
+    return ordered[max(0, -(-len(ordered) * percent // 100) - 1)]
+
+
+def _duration(seconds: float) -> str:
+    if seconds < 1:
+        return f"{seconds * 1000:.2f}ms"
+    return f"{seconds:.2f}s"
+
+
+def _size(value: int) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if value < 1024 or unit == "GiB":
+            return f"{value:.0f}{unit}" if unit == "B" else f"{value:.1f}{unit}"
+        value /= 1024
@@ -1,10 +1,40 @@
-import difflib
 import json
+import sys
+
+import config
+import renamer_daemon
+
+# With the hook_daemon option, the hook is sent to the resident worker before
+# loading anything else. Exits here if the worker did the rename.
+FRAGMENT = json.loads(sys.stdin.read())
+if config.hook_daemon and config.enable_hook and "hookContext" in FRAGMENT["args"]:
+    renamer_daemon.forward_hook(FRAGMENT, __file__)
+# the worker takes its lock first, a second one started at the same time exits here
+DAEMON_LOCK = None
+if FRAGMENT["args"].get("mode") == "daemon":
+    DAEMON_LOCK = renamer_daemon.lock_worker(FRAGMENT["server_connection"]["PluginDir"])
+    if DAEMON_LOCK is None:
+        sys.exit()
+
+import bisect
+import collections
+import datetime
+import difflib
+import errno
+import fnmatch
+import functools
+import hashlib
+import heapq
+import multiprocessing
+import multiprocessing.pool
 import os
+import queue
+import random
 import re
 import shutil
 import sqlite3
-import sys
+import stat
+import threading
 import time
 
 import requests
@@ -22,8 +52,9 @@ except Exception:
     MODULE_UNIDECODE = False
 
 
-import config
 import log
+from phase_timer import PhaseTimer
+from template_compiler import compile_template
 
 DRY_RUN = config.dry_run
 DRY_RUN_FILE = None
@@ -38,7 +69,8 @@ if DRY_RUN:
     log.LogInfo("Dry mode on")
 
 START_TIME = time.time()
-FRAGMENT = json.loads(sys.stdin.read())
+# per-phase timings, in the log at the end (see phase_timer)
+TIMER = PhaseTimer()
 
 FRAGMENT_SERVER = FRAGMENT["server_connection"]
 PLUGIN_DIR = FRAGMENT_SERVER["PluginDir"]
@@ -46,9 +78,26 @@ PLUGIN_DIR = FRAGMENT_SERVER["PluginDir"]
 
 PLUGIN_ARGS = FRAGMENT['args'].get("mode")
 
+# set in the threads/processes computing the plans for the bulk task
+PLAN_WORKER = threading.local()
+HTTP_SESSION = threading.local()
+
 #log.LogDebug("{}".format(FRAGMENT))
 
 
+def phase_timer():
+    # The workers (plans, moves) have their own, merged in the main timer
+    return getattr(PLAN_WORKER, "timer", None) or TIMER
+
+
+def http_session():
+    # One session (kept-alive connection) per process/thread
+    if getattr(HTTP_SESSION, "pid", None) != os.getpid():
+        HTTP_SESSION.session = requests.Session()
+        HTTP_SESSION.pid = os.getpid()
+    return HTTP_SESSION.session
+
+
 def callGraphQL(query, variables=None):
     # Session cookie for authentication
     graphql_port = str(FRAGMENT_SERVER['Port'])
@@ -71,7 +120,8 @@ def callGraphQL(query, variables=None):
     if variables is not None:
         json['variables'] = variables
     try:
-        response = requests.post(graphql_url, json=json, headers=graphql_headers, cookies=graphql_cookies, timeout=20)
+        with phase_timer().phase("graphql"):
+            response = http_session().post(graphql_url, json=json, headers=graphql_headers, cookies=graphql_cookies, timeout=20)
     except Exception as e:
         exit_plugin(err=f"[FATAL] Error with the graphql request {e}")
     if response.status_code == 200:
@@ -95,51 +145,7 @@ def graphql_getScene(scene_id):
             ...SceneData
         }
     }
-    fragment SceneData on Scene {
-        id
-        oshash
-        checksum
-        title
-        date
-        rating
-        organized
-        path
-        file {
-            video_codec
-            audio_codec
-            width
-            height
-            framerate
-            bitrate
-        }
-        studio {
-          id
-          name
-          parent_studio {
-              id
-              name
-          }
-        }
-        tags {
-          id
-          name
-        }
-        performers {
-          id
-          name
-          gender
-          favorite
-          rating
-        }
-        movies {
-            movie {
-                name
-                date
-            }
-            scene_index
-        }
-    }
-    """
+    """ + scene_fragment(tuple(configured_templates()))
     variables = {
         "id": scene_id
     }
@@ -147,73 +153,174 @@ def graphql_getScene(scene_id):
     return result.get('findScene')
 
 
-def graphql_findScene(perPage, direc="DESC") -> dict:
+def graphql_findScene(perPage, direc="DESC", page=1, sort="updated_at", scene_filter=None) -> dict:
     query = """
-    query FindScenes($filter: FindFilterType) {
-        findScenes(filter: $filter) {
+    query FindScenes($filter: FindFilterType, $scene_filter: SceneFilterType) {
+        findScenes(filter: $filter, scene_filter: $scene_filter) {
             count
             scenes {
-                ...SlimSceneData
-            }
-        }
-    }
-    fragment SlimSceneData on Scene {
-        id
-        oshash
-        checksum
-        title
-        date
-        rating
-        organized
-        path
-        file {
-            video_codec
-            audio_codec
-            width
-            height
-            framerate
-            bitrate
-        }
-        studio {
-          id
-          name
-          parent_studio {
-              id
-              name
-          }
-        }
-        tags {
-          id
-          name
-        }
-        performers {
-          id
-          name
-          gender
-          favorite
-          rating
-        }
-        movies {
-            movie {
-                name
-                date
+                ...SceneData
             }
-            scene_index
         }
     }
-    """
+    """ + scene_fragment(tuple(configured_templates()))
     # ASC DESC
-    variables = {'filter': {"direction": direc, "page": 1, "per_page": perPage, "sort": "updated_at"}}
+    variables = {'filter': {"direction": direc, "page": page, "per_page": perPage, "sort": sort}}
+    if scene_filter:
+        variables['scene_filter'] = scene_filter
     result = callGraphQL(query, variables)
     return result.get("findScenes")
 
 
+def scene_source(limit: int, per_page: int, sort="id", scene_filter=None):
+    # Yield (scene, total) page by page, so the renamer starts with the first page
+    # and only one page is kept in memory.
+    # Sorted on id, the next page is the scenes after the last id seen (not a page number):
+    # a scene leaving the filter once renamed (path, clean_tag) doesn't shift the next pages.
+    # Without batch_prefilter (a Stash refusing the filters), the pages are numbered.
+    # scene_filter: SceneFilterType, only these scenes. Always sorted on id.
+    if per_page < 1 or 0 < limit < per_page:
+        per_page = limit
+    if scene_filter:
+        sort = "id"
+    page = 1
+    last_id = None
+    total = None
+    done = 0
+    keyset = sort == "id" and config.batch_prefilter
+    while True:
+        if keyset and last_id is not None:
+            result = graphql_findScene(per_page, "ASC", 1, sort, and_filter({"id": {"value": int(last_id), "modifier": "GREATER_THAN"}}, scene_filter))
+        else:
+            result = graphql_findScene(per_page, "ASC", page, sort, scene_filter)
+        if total is None:
+            total = result["count"]
+            if limit > -1:
+                total = min(total, limit)
+        for scene in result["scenes"]:
+            if done >= total:
+                return
+            done += 1
+            last_id = scene["id"]
+            yield scene, total
+        if per_page < 1 or len(result["scenes"]) < per_page or done >= total:
+            return
+        page += 1
+
+
+def bulk_scene_filter():
+    # SceneFilterType of the scenes that can have a template, so the task doesn't ask the others to Stash.
+    # None: every scene (a default template is used...)
+    scene_filter = None
+    if not config.use_default_template and not config.p_use_default_template:
+        criteria = []
+        tag_names = set(config.tag_templates) | set(config.p_tag_templates)
+        if tag_names:
+            tag_ids = [tag["id"] for tag in graphql_findTags()["tags"] if tag["name"] in tag_names]
+            if tag_ids:
+                criteria.append({"tags": {"value": tag_ids, "modifier": "INCLUDES", "depth": 0}})
+        # the template of a studio is also used by its sub-studios (filename only)
+        for templates, depth in ((config.studio_templates, -1), (config.p_studio_templates, 0)):
+            if templates:
+                studio_ids = [studio_id for studio_id, studio in load_studio_tree().items() if studio["name"] in templates]
+                if studio_ids:
+                    criteria.append({"studios": {"value": studio_ids, "modifier": "INCLUDES", "depth": depth}})
+        if len(config.p_path_templates) > PREFILTER_MAX_PATHS:
+            # too many levels of OR for Stash
+            log.LogDebug(f"More than {PREFILTER_MAX_PATHS} path templates, checking all the scenes")
+            criteria = None
+        else:
+            criteria += [{"path": {"value": match, "modifier": "INCLUDES"}} for match in config.p_path_templates]
+        if criteria is not None and PATH_NON_ORGANIZED:
+            criteria.append({"organized": False})
+        if criteria:
+            # criterion OR (criterion OR (...))
+            for criterion in reversed(criteria):
+                scene_filter = dict(criterion, OR=scene_filter) if scene_filter else criterion
+    if config.only_organized and not PATH_NON_ORGANIZED:
+        scene_filter = and_filter({"organized": True}, scene_filter)
+    return scene_filter
+
+
+def and_filter(criteria: dict, scene_filter=None):
+    # criteria AND scene_filter (the criteria must not have AND/OR/NOT, Stash allows one of them per level)
+    if scene_filter is None:
+        return criteria
+    return dict(criteria, AND=scene_filter)
+
+
+def latest_updated_at():
+    # updated_at of the last edited scene
+    result = graphql_findScene(1, "DESC", 1, "updated_at")
+    if result["scenes"]:
+        return result["scenes"][0]["updated_at"]
+    return None
+
+
+def updated_since(watermark: str):
+    # One second earlier, the scenes edited in the same second are checked again
+    try:
+        stamp = datetime.datetime.fromisoformat(watermark.replace("Z", "+00:00"))
+    except ValueError:
+        return watermark
+    return (stamp - datetime.timedelta(seconds=1)).isoformat()
+
+
+def incremental_source(state: dict, per_page: int, sort="id", scene_filter=None):
+    # Scenes edited since the last bulk run, then the scenes that failed during it
+    # scene_filter: SceneFilterType, only these scenes (bulk_scene_filter)
+    scene_filter = and_filter({"updated_at": {"value": updated_since(state["updated_at"]), "modifier": "GREATER_THAN"}}, scene_filter)
+    retry = state.get("retry", [])
+    seen = set()
+    total = len(retry)
+    for scene, count in scene_source(-1, per_page, sort, scene_filter):
+        total = count + len(retry)
+        seen.add(scene["id"])
+        yield scene, total
+    for scene_id in retry:
+        if scene_id in seen:
+            continue
+        scene = graphql_getScene(scene_id)
+        if scene:
+            yield scene, total
+
+
+def config_hash():
+    # Changes when an option that can change the new paths is edited, or the plugin is updated
+    values = {k: repr(v) for k, v in vars(config).items() if not k.startswith("_") and k not in INCREMENTAL_IGNORED_CONFIG}
+    digest = hashlib.sha1(json.dumps(values, sort_keys=True).encode())
+    for source in (__file__, os.path.join(PLUGIN_DIR, "template_compiler.py")):
+        with open(source, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def load_bulk_state():
+    try:
+        with open(BULK_STATE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_bulk_state(state: dict):
+    try:
+        with open(BULK_STATE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+    except OSError as err:
+        log.LogWarning(f"Can't save the bulk state ({err})")
+
+
 def graphql_getConfiguration():
     query = """
         query Configuration {
             configuration {
                 general {
                     databasePath
+                    videoExtensions
+                    stashes {
+                        path
+                    }
                 }
             }
         }
@@ -242,6 +349,43 @@ def graphql_getStudio(studio_id):
     return result.get("findStudio")
 
 
+def graphql_findStudios(perPage, direc="DESC", sort="updated_at"):
+    query = """
+        query FindStudios($filter: FindFilterType) {
+            findStudios(filter: $filter) {
+                count
+                studios {
+                    id
+                    name
+                    updated_at
+                    parent_studio {
+                        id
+                    }
+                }
+            }
+        }
+    """
+    variables = {'filter': {"direction": direc, "page": 1, "per_page": perPage, "sort": sort}}
+    result = callGraphQL(query, variables)
+    return result.get("findStudios")
+
+
+def graphql_findTags():
+    query = """
+        query FindTags($filter: FindFilterType) {
+            findTags(filter: $filter) {
+                tags {
+                    id
+                    name
+                }
+            }
+        }
+    """
+    variables = {'filter': {"page": 1, "per_page": -1}}
+    result = callGraphQL(query, variables)
+    return result.get("findTags")
+
+
 def graphql_removeScenesTag(id_scenes: list, id_tags: list):
     query = """
     mutation BulkSceneUpdate($input: BulkSceneUpdateInput!) {
@@ -278,7 +422,90 @@ def find_diff_text(a: str, b: str):
     return
 
 
+def proc_open_files(pids=None):
+    # {(device, inode): {pid}} of the regular files opened by the processes, read from /proc.
+    # A single pass over /proc/*/fd, instead of asking every process for its list of files.
+    handles = {}
+    if pids is None:
+        pids = [int(pid) for pid in os.listdir("/proc") if pid.isdigit()]
+    for pid in pids:
+        fd_dir = f"/proc/{pid}/fd"
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                fd_stat = os.stat(os.path.join(fd_dir, fd))
+            except OSError:
+                continue
+            if stat.S_ISREG(fd_stat.st_mode):
+                handles.setdefault((fd_stat.st_dev, fd_stat.st_ino), set()).add(pid)
+    return handles
+
+
+def proc_handle_pids(fpath, fresh=False):
+    # The scan of /proc is kept for the whole run (bulk task), the processes found in it are
+    # checked again. fresh: scan /proc again first (the file was found busy).
+    global PROC_HANDLES
+    file_stat = os.stat(fpath)
+    key = (file_stat.st_dev, file_stat.st_ino)
+    if fresh or PROC_HANDLES is None:
+        PROC_HANDLES = proc_open_files()
+    return sorted(pid for pid in PROC_HANDLES.get(key, ()) if key in proc_open_files([pid]))
+
+
+def proc_writers(fpath):
+    # pids having the file open for writing (flags of /proc/<pid>/fdinfo), among the
+    # processes of the /proc scan kept for the run
+    file_stat = os.stat(fpath)
+    key = (file_stat.st_dev, file_stat.st_ino)
+    writers = []
+    for pid in proc_handle_pids(fpath):
+        try:
+            fds = os.listdir(f"/proc/{pid}/fd")
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                fd_stat = os.stat(f"/proc/{pid}/fd/{fd}")
+                if (fd_stat.st_dev, fd_stat.st_ino) != key:
+                    continue
+                with open(f"/proc/{pid}/fdinfo/{fd}", encoding="ascii") as f:
+                    flags = next(int(line.split()[1], 8) for line in f if line.startswith("flags:"))
+            except (OSError, StopIteration, ValueError):
+                continue
+            if flags & (os.O_WRONLY | os.O_RDWR):
+                writers.append(pid)
+                break
+    return writers
+
+
+def file_busy(err: OSError):
+    # The file is used by another process: sharing violation (Windows), busy (Linux, see move_file)
+    return "[WinError 32]" in str(err) or err.errno in (errno.EBUSY, errno.ETXTBSY)
+
+
 def has_handle(fpath, all_result=False):
+    if not PROC_FD:
+        return psutil_handle(fpath, all_result)
+    lst = []
+    try:
+        pids = proc_handle_pids(fpath, fresh=True)
+    except OSError:
+        pids = []
+    for pid in pids:
+        try:
+            proc = psutil.Process(pid)
+        except psutil.NoSuchProcess:
+            continue
+        if not all_result:
+            return proc
+        lst.append(proc)
+    return lst
+
+
+def psutil_handle(fpath, all_result=False):
     lst = []
     for proc in psutil.process_iter():
         try:
@@ -320,57 +547,154 @@ def check_longpath(path: str):
         return 1
 
 
+def load_studio_tree(check=False):
+    # Every studio (name, parent) in one query, for $studio_hierarchy and the studio templates.
+    # Saved in the plugin folder and reused until a studio is created, edited or deleted.
+    # check: reload the tree already loaded if the studios have changed (hook worker)
+    global STUDIO_TREE, STUDIO_TREE_KEY
+    if STUDIO_TREE is not None and not check:
+        return STUDIO_TREE
+    latest = graphql_findStudios(1)
+    cache_key = {"count": latest["count"], "updated_at": latest["studios"][0]["updated_at"] if latest["studios"] else None}
+    if STUDIO_TREE is not None and cache_key == STUDIO_TREE_KEY:
+        return STUDIO_TREE
+    STUDIO_TREE_KEY = cache_key
+    try:
+        with open(STUDIO_CACHE_FILE, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+        if cache.get("key") == cache_key:
+            STUDIO_TREE = cache["studios"]
+            log.LogDebug(f"Studio tree loaded from cache ({len(STUDIO_TREE)} studios)")
+            return STUDIO_TREE
+    except (OSError, ValueError):
+        pass
+    result = graphql_findStudios(-1)
+    STUDIO_TREE = {}
+    for studio in result["studios"]:
+        parent = studio.get("parent_studio")
+        STUDIO_TREE[studio["id"]] = {"name": studio["name"], "parent": parent["id"] if parent else None}
+    log.LogDebug(f"Studio tree loaded ({len(STUDIO_TREE)} studios)")
+    try:
+        with open(STUDIO_CACHE_FILE, 'w', encoding='utf-8') as f:
+            json.dump({"key": cache_key, "studios": STUDIO_TREE}, f)
+    except OSError as err:
+        log.LogWarning(f"Can't save the studio cache ({err})")
+    return STUDIO_TREE
+
+
+@functools.lru_cache(maxsize=None)
+def studio_ancestors(studio_id: str) -> tuple:
+    # Names of the studio and its parents, from the studio to the top parent
+    tree = load_studio_tree()
+    names = []
+    while studio_id:
+        if studio_id not in tree:
+            # not in the tree (created during the run), ask Stash
+            studio = graphql_getStudio(studio_id)
+            if not studio:
+                break
+            tree[studio_id] = {"name": studio["name"], "parent": studio["parent_studio"]["id"] if studio.get("parent_studio") else None}
+        names.append(tree[studio_id]["name"])
+        studio_id = tree[studio_id]["parent"]
+        if len(names) > len(tree):
+            log.LogWarning("Loop in the studio hierarchy")
+            break
+    return tuple(names)
+
+
+def get_studio_hierarchy(studio: dict) -> tuple:
+    if not studio.get("parent_studio"):
+        return (studio["name"],)
+    return studio_ancestors(studio["id"])
+
+
+@functools.lru_cache(maxsize=None)
+def studio_template_filename(studio_id: str, studio_name: str, has_parent: bool):
+    # First template found for the studio or its parents
+    if config.studio_templates.get(studio_name):
+        return config.studio_templates[studio_name]
+    if has_parent:
+        for name in studio_ancestors(studio_id)[1:]:
+            if config.studio_templates.get(name):
+                return config.studio_templates[name]
+    return None
+
+
+def compile_tag_rules(rules: dict) -> dict:
+    # tag name -> (position in the config, template), the first rule of the config wins
+    return {tag: (priority, job) for priority, (tag, job) in enumerate(rules.items())}
+
+
+def match_tag_rule(tag_rules: dict, scene: dict):
+    # One lookup per tag of the scene, whatever the number of rules
+    best = None
+    for tag in scene.get("tags") or ():
+        rule = tag_rules.get(tag["name"])
+        if rule is not None and (best is None or rule[0] < best[0]):
+            best = rule
+    return best
+
+
+def compile_path_rules(rules: dict) -> dict:
+    # Trie of the paths (one node per character), the end of a rule is under the key None: (position in the config, template)
+    trie = {}
+    for priority, (match, job) in enumerate(rules.items()):
+        node = trie
+        for char in match:
+            node = node.setdefault(char, {})
+        node.setdefault(None, (priority, job))
+    return trie
+
+
+def match_path_rule(trie: dict, path: str):
+    # A rule matches anywhere in the path (like 'match in path'), the first rule of the config wins.
+    # The trie is walked from each character of the path, the cost depends on the path, not on the number of rules.
+    best = trie.get(None)
+    for start in range(len(path)):
+        node = trie
+        for char in path[start:]:
+            node = node.get(char)
+            if node is None:
+                break
+            rule = node.get(None)
+            if rule is not None and (best is None or rule[0] < best[0]):
+                best = rule
+    return best
+
+
 def get_template_filename(scene: dict):
     template = None
     # Change by Studio
-    if scene.get("studio") and config.p_studio_templates:
-        template_found = False
-        current_studio = scene.get("studio")
-        if config.studio_templates.get(current_studio['name']):
-            template = config.studio_templates[current_studio['name']]
-            template_found = True
-        # by first Parent found
-        while current_studio.get("parent_studio") and not template_found:
-            if config.studio_templates.get(current_studio.get("parent_studio").get("name")):
-                template = config.studio_templates[current_studio['parent_studio']['name']]
-                template_found = True
-            current_studio = graphql_getStudio(current_studio.get("parent_studio")['id'])
+    if scene.get("studio") and config.studio_templates:
+        studio = scene["studio"]
+        template = studio_template_filename(studio["id"], studio["name"], bool(studio.get("parent_studio")))
 
     # Change by Tag
-    tags = [x["name"] for x in scene["tags"]]
-    if scene.get("tags") and config.tag_templates:
-        for match, job in config.tag_templates.items():
-            if match in tags:
-                template = job
-                break
+    if TAG_TEMPLATES:
+        rule = match_tag_rule(TAG_TEMPLATES, scene)
+        if rule:
+            template = rule[1]
     return template
 
 
 def get_template_path(scene: dict):
     template = {"destination": "", "option": [], "opt_details": {}}
     # Change by Path
-    if config.p_path_templates:
-        for match, job in config.p_path_templates.items():
-            if match in scene["path"]:
-                template["destination"] = job
-                break
+    if P_PATH_TEMPLATES:
+        rule = match_path_rule(P_PATH_TEMPLATES, scene["path"])
+        if rule:
+            template["destination"] = rule[1]
 
     # Change by Studio
     if scene.get("studio") and config.p_studio_templates:
         if config.p_studio_templates.get(scene["studio"]["name"]):
             template["destination"] = config.p_studio_templates[scene["studio"]["name"]]
-        # by Parent
-        if scene["studio"].get("parent_studio"):
-            if config.p_studio_templates.get(scene["studio"]["name"]):
-                template["destination"] = config.p_studio_templates[scene["studio"]["name"]]
 
     # Change by Tag
-    tags = [x["name"] for x in scene["tags"]]
-    if scene.get("tags") and config.p_tag_templates:
-        for match, job in config.p_tag_templates.items():
-            if match in tags:
-                template["destination"] = job
-                break
+    if P_TAG_TEMPLATES:
+        rule = match_tag_rule(P_TAG_TEMPLATES, scene)
+        if rule:
+            template["destination"] = rule[1]
 
     if scene.get("tags") and config.p_tag_option:
         for tag in scene["tags"]:
@@ -387,6 +711,79 @@ def get_template_path(scene: dict):
     return template
 
 
+def configured_templates():
+    # Every filename/path template that can be used with the config
+    templates = list(config.tag_templates.values()) + list(config.studio_templates.values())
+    templates += list(config.p_tag_templates.values()) + list(config.p_studio_templates.values()) + list(config.p_path_templates.values())
+    if config.use_default_template:
+        templates.append(config.default_template)
+    if config.p_use_default_template:
+        templates.append(config.p_default_template)
+    if PATH_NON_ORGANIZED:
+        templates.append(PATH_NON_ORGANIZED)
+    return templates
+
+
+@functools.lru_cache(maxsize=None)
+def template_fields(templates: tuple) -> frozenset:
+    # Field names ("date", "performer"...) used by the templates
+    fields = set()
+    for template in templates:
+        fields.update(compile_template(template, TEMPLATE_FIELD + ("$studio_hierarchy",)).fields)
+    return frozenset(fields)
+
+
+@functools.lru_cache(maxsize=None)
+def scene_fragment(templates: tuple) -> str:
+    # The scene fields asked to Stash, only the objects the templates and options use
+    selections = set()
+    for name in template_fields(templates):
+        selections.update(SCENE_FIELD_SELECTIONS.get(name, ()))
+    if config.tag_templates or config.p_tag_templates or config.p_tag_option:
+        selections.add("tags")
+    if config.studio_templates or config.p_studio_templates:
+        selections.add("studio")
+    lines = ["id", "oshash", "checksum", "title", "date", "rating", "organized", "path", "updated_at"]
+    for name, selection in SCENE_SELECTIONS.items():
+        if name in selections:
+            lines.append(selection)
+    if "performers" in selections:
+        performer = ["id", "name"]
+        if PERFORMER_IGNOREGENDER:
+            performer.append("gender")
+        if PERFORMER_SORT in ("rating", "mix", "mixid"):
+            performer.append("rating")
+        if PERFORMER_SORT in ("favorite", "mix", "mixid"):
+            performer.append("favorite")
+        lines.append("performers { " + " ".join(performer) + " }")
+    return "fragment SceneData on Scene {\n" + "".join(f"        {line}\n" for line in lines) + "    }"
+
+
+@functools.lru_cache(maxsize=None)
+def hook_input_fields() -> frozenset:
+    # Fields of the scene update (SceneUpdateInput, or BulkSceneUpdateInput for a bulk edit)
+    # that can change the result of the plugin
+    fields = set(HOOK_INPUT_ALWAYS)
+    for name in template_fields(tuple(configured_templates())):
+        fields.update(HOOK_INPUT_FIELDS.get(name, ()))
+    if config.tag_templates or config.p_tag_templates or config.p_tag_option:
+        fields.add("tag_ids")
+    if config.studio_templates or config.p_studio_templates:
+        fields.add("studio_id")
+    if config.only_organized or PATH_NON_ORGANIZED:
+        fields.add("organized")
+    return frozenset(fields)
+
+
+def hook_has_changes(hook_context: dict):
+    # False if the update only changed fields that the plugin doesn't use (rating, o_counter, markers...)
+    changed = hook_context.get("inputFields")
+    if not changed:
+        # no details (scan...), check the scene
+        return True
+    return not hook_input_fields().isdisjoint(changed)
+
+
 def sort_performer(lst_use: list, lst_app=[]):
     for p in lst_use:
         lst_use[p].sort()
@@ -397,251 +794,422 @@ def sort_performer(lst_use: list, lst_app=[]):
     return lst_app
 
 
+class SceneInformation(dict):
+    # Fields of a scene for the templates. The paths are set by extract_info, the other
+    # fields are extracted from the Stash scene the first time they are read
+    # (scene_information['performer'] or .get('performer')), once per scene:
+    # the performer sorting, tag filters... only run for the templates that use them.
+    def __init__(self, scene: dict, template: dict):
+        super().__init__()
+        self.scene = scene
+        self.template = template
+        self.extracted = set()
+
+    def __missing__(self, key):
+        if self.extract(key):
+            return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def extract(self, key) -> bool:
+        extractor = SCENE_FIELD_EXTRACTORS.get(key)
+        if extractor is None or extractor in self.extracted:
+            return False
+        self.extracted.add(extractor)
+        for name, value in extractor(self.scene, self.template).items():
+            self[name] = whitespace_field(value)
+        return dict.__contains__(self, key)
+
+    def __reduce__(self):
+        # sent by the workers as a plain dict, with the fields used by the templates
+        return dict, (dict(self),)
+
+
+def whitespace_field(value):
+    if FIELD_WHITESPACE_SEP:
+        if type(value) is str:
+            return value.replace(" ", FIELD_WHITESPACE_SEP)
+        if type(value) is list:
+            return [x.replace(" ", FIELD_WHITESPACE_SEP) for x in value]
+    return value
+
+
 def extract_info(scene: dict, template: None):
     # Grabbing things from Stash
-    scene_information = {}
+    scene_information = SceneInformation(scene, template)
+    fields = {}
 
-    scene_information['current_path'] = str(scene['path'])
+    fields['current_path'] = str(scene['path'])
     # note: contain the dot (.mp4)
-    scene_information['file_extension'] = os.path.splitext(scene_information['current_path'])[1]
+    fields['file_extension'] = os.path.splitext(fields['current_path'])[1]
     # note: basename contains the extension
-    scene_information['current_filename'] = os.path.basename(scene_information['current_path'])
-    scene_information['current_directory'] = os.path.dirname(scene_information['current_path'])
-    scene_information['oshash'] = scene['oshash']
-    scene_information['checksum'] = scene.get("checksum")
+    fields['current_filename'] = os.path.basename(fields['current_path'])
+    fields['current_directory'] = os.path.dirname(fields['current_path'])
+    fields['oshash'] = scene['oshash']
+    fields['checksum'] = scene.get("checksum")
 
     if template.get("path"):
         if "^*" in template["path"]["destination"]:
-            template["path"]["destination"] = template["path"]["destination"].replace("^*", scene_information['current_directory'])
-        scene_information['template_split'] = os.path.normpath(template["path"]["destination"]).split(os.sep)
-    scene_information['current_path_split'] = os.path.normpath(scene_information['current_path']).split(os.sep)
-
-    # Grab Title (without extension if present)
-    if scene.get("title"):
-        # Removing extension if present in title
-        scene_information['title'] = re.sub(fr"{scene_information['file_extension']}$", "", scene['title'])
-        if PREPOSITIONS_REMOVAL:
-            for word in PREPOSITIONS_LIST:
-                scene_information['title'] = re.sub(fr"^{word}[\s_-]", "", scene_information['title'])
+            template["path"]["destination"] = template["path"]["destination"].replace("^*", fields['current_directory'])
+        fields['template_split'] = os.path.normpath(template["path"]["destination"]).split(os.sep)
+    fields['current_path_split'] = os.path.normpath(fields['current_path']).split(os.sep)
 
     # Grab Date
-    scene_information['date'] = scene.get("date")
+    fields['date'] = scene.get("date")
+
+    for key, value in fields.items():
+        scene_information[key] = whitespace_field(value)
+    return scene_information
 
-    # Grab Rating
-    if scene.get("rating"):
-        scene_information['rating'] = RATING_FORMAT.format(scene['rating'])
 
-    # Grab Performer
-    scene_information['performer_path'] = None
-    if scene.get("performers"):
+def extract_title(scene: dict, template: dict):
+    # Grab Title (without extension if present)
+    if not scene.get("title"):
+        return {}
+    # Removing extension if present in title
+    title = re.sub(fr"{os.path.splitext(str(scene['path']))[1]}$", "", scene['title'])
+    if PREPOSITIONS_REMOVAL:
+        for word in PREPOSITIONS_LIST:
+            title = re.sub(fr"^{word}[\s_-]", "", title)
+    return {"title": title}
+
+
+def extract_year(scene: dict, template: dict):
+    if not scene.get("date"):
+        return {}
+    return {"year": scene["date"][0:4]}
+
+
+def extract_rating(scene: dict, template: dict):
+    if not scene.get("rating"):
+        return {}
+    return {"rating": RATING_FORMAT.format(scene['rating'])}
+
+
+def extract_performers(scene: dict, template: dict):
+    # $performer and the performer used for the path ($performer in a path template)
+    fields = {'performer_path': None}
+    if not scene.get("performers"):
+        if PATH_NOPERFORMER_FOLDER:
+            fields['performer_path'] = "NoPerformer"
+        return fields
+    current_path_split = os.path.normpath(str(scene['path'])).split(os.sep)
+    perf_list = []
+    perf_rating = {"5": [], "4": [], "3": [], "2": [], "1": [], "0": []}
+    perf_favorite = {"yes": [], "no": []}
+    for perf in scene['performers']:
+        if perf.get("gender"):
+            if perf['gender'] in PERFORMER_IGNOREGENDER:
+                continue
+        # path related
+        if template.get("path"):
+            if "inverse_performer" in template["path"]["option"]:
+                perf["name"] = re.sub(r"([a-zA-Z]+)(\s)([a-zA-Z]+)", r"\3 \1", perf["name"])
+        perf_list.append(perf['name'])
+        if perf.get('rating'):
+            perf_rating[str(perf['rating'])].append(perf['name'])
+        else:
+            perf_rating["0"].append(perf['name'])
+        if perf.get('favorite'):
+            perf_favorite['yes'].append(perf['name'])
+        else:
+            perf_favorite['no'].append(perf['name'])
+        # if the path already contains the name we keep this one
+        if perf["name"] in current_path_split and fields['performer_path'] is None and PATH_KEEP_ALRPERF:
+            fields['performer_path'] = perf["name"]
+            log.LogDebug(f"[PATH] Keeping the current name of the performer '{perf['name']}'")
+    # sort performer
+    if PERFORMER_SORT == "rating":
+        # sort alpha
+        perf_list = sort_performer(perf_rating)
+    elif PERFORMER_SORT == "favorite":
+        perf_list = sort_performer(perf_favorite)
+    elif PERFORMER_SORT == "mix":
         perf_list = []
-        perf_rating = {"5": [], "4": [], "3": [], "2": [], "1": [], "0": []}
-        perf_favorite = {"yes": [], "no": []}
-        for perf in scene['performers']:
-            if perf.get("gender"):
-                if perf['gender'] in PERFORMER_IGNOREGENDER:
-                    continue
-            # path related
-            if template.get("path"):
-                if "inverse_performer" in template["path"]["option"]:
-                    perf["name"] = re.sub(r"([a-zA-Z]+)(\s)([a-zA-Z]+)", r"\3 \1", perf["name"])
-            perf_list.append(perf['name'])
-            if perf.get('rating'):
-                perf_rating[str(perf['rating'])].append(perf['name'])
-            else:
-                perf_rating["0"].append(perf['name'])
-            if perf.get('favorite'):
-                perf_favorite['yes'].append(perf['name'])
-            else:
-                perf_favorite['no'].append(perf['name'])
-            # if the path already contains the name we keep this one
-            if perf["name"] in scene_information['current_path_split'] and scene_information.get('performer_path') is None and PATH_KEEP_ALRPERF:
-                scene_information['performer_path'] = perf["name"]
-                log.LogDebug(f"[PATH] Keeping the current name of the performer '{perf['name']}'")
-        # sort performer
-        if PERFORMER_SORT == "rating":
-            # sort alpha
-            perf_list = sort_performer(perf_rating)
-        elif PERFORMER_SORT == "favorite":
-            perf_list = sort_performer(perf_favorite)
-        elif PERFORMER_SORT == "mix":
-            perf_list = []
-            for p in perf_favorite:
-                perf_favorite[p].sort()
-            for p in perf_favorite.get("yes"):
-                perf_list.append(p)
-            perf_list = sort_performer(perf_rating, perf_list)
-        elif PERFORMER_SORT == "mixid":
+        for p in perf_favorite:
+            perf_favorite[p].sort()
+        for p in perf_favorite.get("yes"):
+            perf_list.append(p)
+        perf_list = sort_performer(perf_rating, perf_list)
+    elif PERFORMER_SORT == "mixid":
+        perf_list = []
+        for p in perf_favorite.get("yes"):
+            perf_list.append(p)
+        for p in perf_rating.values():
+            for n in p:
+                if n not in perf_list:
+                    perf_list.append(n)
+    elif PERFORMER_SORT == "name":
+        perf_list.sort()
+    if not fields['performer_path'] and perf_list:
+        fields['performer_path'] = perf_list[0]
+    if len(perf_list) > PERFORMER_LIMIT:
+        if not PERFORMER_LIMIT_KEEP:
+            log.LogInfo(f"More than {PERFORMER_LIMIT} performer(s). Ignoring $performer")
             perf_list = []
-            for p in perf_favorite.get("yes"):
-                perf_list.append(p)
-            for p in perf_rating.values():
-                for n in p:
-                    if n not in perf_list:
-                        perf_list.append(n)
-        elif PERFORMER_SORT == "name":
-            perf_list.sort()
-        if not scene_information['performer_path'] and perf_list:
-            scene_information['performer_path'] = perf_list[0]
-        if len(perf_list) > PERFORMER_LIMIT:
-            if not PERFORMER_LIMIT_KEEP:
-                log.LogInfo(f"More than {PERFORMER_LIMIT} performer(s). Ignoring $performer")
-                perf_list = []
-            else:
-                log.LogInfo(f"Limited the amount of performer to {PERFORMER_LIMIT}")
-                perf_list = perf_list[0: PERFORMER_LIMIT]
-        scene_information['performer'] = PERFORMER_SPLITCHAR.join(perf_list)
-        if not PATH_ONEPERFORMER:
-            scene_information['performer_path'] = PERFORMER_SPLITCHAR.join(perf_list)
-    elif PATH_NOPERFORMER_FOLDER:
-        scene_information['performer_path'] = "NoPerformer"
+        else:
+            log.LogInfo(f"Limited the amount of performer to {PERFORMER_LIMIT}")
+            perf_list = perf_list[0: PERFORMER_LIMIT]
+    fields['performer'] = PERFORMER_SPLITCHAR.join(perf_list)
+    if not PATH_ONEPERFORMER:
+        fields['performer_path'] = PERFORMER_SPLITCHAR.join(perf_list)
+    return fields
+
+
+def studio_name(name: str):
+    if SQUEEZE_STUDIO_NAMES:
+        return name.replace(' ', '')
+    return name
+
 
+def extract_studio(scene: dict, template: dict):
     # Grab Studio name
-    if scene.get("studio"):
-        if SQUEEZE_STUDIO_NAMES:
-            scene_information['studio'] = scene['studio']['name'].replace(' ', '')
-        else:
-            scene_information['studio'] = scene['studio']['name']
-        scene_information['studio_family'] = scene_information['studio']
-        studio_hierarchy = [scene_information['studio']]
-        # Grab Parent name
-        if scene['studio'].get("parent_studio"):
-            if SQUEEZE_STUDIO_NAMES:
-                scene_information['parent_studio'] = scene['studio']['parent_studio']['name'].replace(' ', '')
-            else:
-                scene_information['parent_studio'] = scene['studio']['parent_studio']['name']
-            scene_information['studio_family'] = scene_information['parent_studio']
-
-            studio_p = scene['studio']
-            while studio_p.get("parent_studio"):
-                studio_p = graphql_getStudio(studio_p['parent_studio']['id'])
-                if studio_p:
-                    studio_hierarchy.append(studio_p['name'])
-            studio_hierarchy.reverse()
-        scene_information['studio_hierarchy'] = studio_hierarchy
+    if not scene.get("studio"):
+        return {}
+    fields = {'studio': studio_name(scene['studio']['name'])}
+    fields['studio_family'] = fields['studio']
+    # Grab Parent name
+    if scene['studio'].get("parent_studio"):
+        fields['parent_studio'] = studio_name(scene['studio']['parent_studio']['name'])
+        fields['studio_family'] = fields['parent_studio']
+    return fields
+
+
+def extract_studio_hierarchy(scene: dict, template: dict):
+    if not scene.get("studio"):
+        return {}
+    studio_hierarchy = [studio_name(scene['studio']['name'])]
+    if scene['studio'].get("parent_studio"):
+        studio_hierarchy.extend(get_studio_hierarchy(scene['studio'])[1:])
+        studio_hierarchy.reverse()
+    return {'studio_hierarchy': studio_hierarchy}
+
+
+def extract_tags(scene: dict, template: dict):
     # Grab Tags
-    if scene.get("tags"):
-        tag_list = []
-        for tag in scene['tags']:
-            # ignore tag in blacklist
-            if tag['name'] in TAGS_BLACKLIST:
-                continue
-            # check if there is a whilelist
-            if len(TAGS_WHITELIST) > 0:
-                if tag['name'] in TAGS_WHITELIST:
-                    tag_list.append(tag['name'])
-            else:
+    if not scene.get("tags"):
+        return {}
+    tag_list = []
+    for tag in scene['tags']:
+        # ignore tag in blacklist
+        if tag['name'] in TAGS_BLACKLIST:
+            continue
+        # check if there is a whilelist
+        if len(TAGS_WHITELIST) > 0:
+            if tag['name'] in TAGS_WHITELIST:
                 tag_list.append(tag['name'])
-        scene_information['tags'] = TAGS_SPLITCHAR.join(tag_list)
+        else:
+            tag_list.append(tag['name'])
+    return {'tags': TAGS_SPLITCHAR.join(tag_list)}
+
 
+def extract_file(scene: dict, template: dict):
+    # file fields, only asked to Stash if a template uses them
+    if not scene.get("file"):
+        return {}
+    fields = {}
     # Grab Height (720p,1080p,4k...)
-    scene_information['bitrate'] = str(round(int(scene['file']['bitrate']) / 1000000, 2))
-    scene_information['resolution'] = 'SD'
-    scene_information['height'] = f"{scene['file']['height']}p"
+    fields['bitrate'] = str(round(int(scene['file']['bitrate']) / 1000000, 2))
+    fields['resolution'] = 'SD'
+    fields['height'] = f"{scene['file']['height']}p"
     if scene['file']['height'] >= 720:
-        scene_information['resolution'] = 'HD'
+        fields['resolution'] = 'HD'
     if scene['file']['height'] >= 2160:
-        scene_information['height'] = '4k'
-        scene_information['resolution'] = 'UHD'
+        fields['height'] = '4k'
+        fields['resolution'] = 'UHD'
     if scene['file']['height'] >= 2880:
-        scene_information['height'] = '5k'
+        fields['height'] = '5k'
     if scene['file']['height'] >= 3384:
-        scene_information['height'] = '6k'
+        fields['height'] = '6k'
     if scene['file']['height'] >= 4320:
-        scene_information['height'] = '8k'
+        fields['height'] = '8k'
     # For Phone ?
     if scene['file']['height'] > scene['file']['width']:
-        scene_information['resolution'] = 'VERTICAL'
-
-    if scene.get("movies"):
-        scene_information["movie_title"] = scene["movies"][0]["movie"]["name"]
-        if scene["movies"][0]["movie"].get("date"):
-            scene_information["movie_year"] = scene["movies"][0]["movie"]["date"][0:4]
-        if scene["movies"][0].get("scene_index"):
-            scene_information["movie_index"] = scene["movies"][0]["scene_index"]
+        fields['resolution'] = 'VERTICAL'
 
     # Grab Video and Audio codec
-    scene_information['video_codec'] = scene['file']['video_codec'].upper()
-    scene_information['audio_codec'] = scene['file']['audio_codec'].upper()
-
-    if scene_information.get("date"):
-        scene_information['year'] = scene_information['date'][0:4]
-
-    if FIELD_WHITESPACE_SEP:
-        for key, value in scene_information.items():
-            if type(value) is str:
-                scene_information[key] = value.replace(" ", FIELD_WHITESPACE_SEP)
-            elif type(value) is list:
-                scene_information[key] = [x.replace(" ", FIELD_WHITESPACE_SEP) for x in value]
-    return scene_information
+    fields['video_codec'] = scene['file']['video_codec'].upper()
+    fields['audio_codec'] = scene['file']['audio_codec'].upper()
+    return fields
+
+
+def extract_movie(scene: dict, template: dict):
+    if not scene.get("movies"):
+        return {}
+    fields = {"movie_title": scene["movies"][0]["movie"]["name"]}
+    if scene["movies"][0]["movie"].get("date"):
+        fields["movie_year"] = scene["movies"][0]["movie"]["date"][0:4]
+    if scene["movies"][0].get("scene_index"):
+        fields["movie_index"] = scene["movies"][0]["scene_index"]
+    return fields
+
+
+def cached_transform(transform, value: str) -> str:
+    # transform(value), the last TRANSFORM_CACHE_MAX results are kept. The folders of a
+    # path (performer, studio...) are the same for many scenes, their cleanup is done once.
+    key = (transform, value)
+    with TRANSFORM_CACHE_LOCK:
+        result = TRANSFORM_CACHE.get(key)
+        if result is not None:
+            TRANSFORM_CACHE.move_to_end(key)
+    if result is not None:
+        phase_timer().count("transform cache hits")
+        return result
+    phase_timer().count("transform cache misses")
+    result = transform(value)
+    with TRANSFORM_CACHE_LOCK:
+        TRANSFORM_CACHE[key] = result
+        if len(TRANSFORM_CACHE) > TRANSFORM_CACHE_MAX:
+            TRANSFORM_CACHE.popitem(last=False)
+    return result
 
 
 def cleanup_text(text: str):
     # cleanup
-    new_filename = re.sub(r'[\s_-]+(?=[^a-zA-Z0-9_#]{2})', ' ', text)
+    new_filename = CLEANUP_SEPARATOR_RE.sub(' ', text)
     # remove multi space
-    new_filename = re.sub(r'\s+', ' ', new_filename)
+    new_filename = CLEANUP_SPACE_RE.sub(' ', new_filename)
     # remove thing like 'test - ]'
-    for c in ["[", "("]:
-        new_filename = re.sub(r'{}[_\s-]+'.format("\\" + c), c, new_filename)
-    for c in ["]", ")"]:
-        new_filename = re.sub(r'[_\s-]+{}'.format("\\" + c), c, new_filename)
+    new_filename = CLEANUP_OPEN_RE.sub(r'\1', new_filename)
+    new_filename = CLEANUP_CLOSE_RE.sub(r'\1', new_filename)
     # remove () []
-    new_filename = re.sub(r'\(\W*\)|\[\W*\]', '', new_filename)
+    new_filename = CLEANUP_EMPTY_RE.sub('', new_filename)
     # remove {}
-    new_filename = re.sub(r'[{}]', '', new_filename)
+    new_filename = CLEANUP_BRACES_RE.sub('', new_filename)
     # remove multi space
-    new_filename = re.sub(r'\s+', ' ', new_filename)
+    new_filename = CLEANUP_SPACE_RE.sub(' ', new_filename)
     # Remove space at start/end
     new_filename = new_filename.strip(" -_")
     return new_filename
 
 
-def replace_text(text: str):
-    for old, new in FILENAME_REPLACEWORDS.items():
+def compile_replace_words(rules: dict):
+    # replace_words compiled once into passes of (regex, replacement).
+    # Consecutive 'word'/'any' rules are merged in one regex, so the filename is scanned
+    # once per group instead of once per rule: the leftmost match wins, at the same
+    # position the first rule in the config. 'regex' rules keep one pass each, like the
+    # 'word' rules with a capture group (their \1... are numbered in their own regex).
+    groups = []
+    for old, new in rules.items():
         if type(new) is str:
             new = [new]
-        if len(new) > 1:
-            if new[1] == "regex":
-                tmp = re.sub(old, new[0], text)
-                if tmp != text:
-                    log.LogDebug(f"Regex matched: {text} -> {tmp}")
-            else:
-                if new[1] == "word":
-                    tmp = re.sub(fr'([\s_-])({old})([\s_-])', f'\\1{new[0]}\\3', text)
-                elif new[1] == "any":
-                    tmp = text.replace(old, new[0])
-                if tmp != text:
-                    log.LogDebug(f"'{old}' changed with '{new[0]}'")
+        system = new[1] if len(new) > 1 else "word"
+        if system not in ("word", "any", "regex"):
+            log.LogWarning(f"replace_words: unknown system '{system}' for '{old}', ignored")
+            continue
+        if system == "any" and not old:
+            continue
+        if system == "word" and capture_groups(old):
+            system = "word_groups"
+        if system in ("word", "any") and groups and groups[-1][0] == system:
+            groups[-1][1].append((old, new[0]))
+        else:
+            groups.append((system, [(old, new[0])]))
+    passes = []
+    for system, group in groups:
+        if system == "regex":
+            old, new = group[0]
+            passes.append((re.compile(old), new))
+        elif system == "word_groups":
+            old, new = group[0]
+            passes.append(compile_replace_word_groups(old, new))
+        elif system == "any":
+            passes.append((re.compile("|".join(re.escape(old) for old, _ in group)), replace_any(dict(group))))
         else:
-            tmp = re.sub(fr'([\s_-])({old})([\s_-])', f'\\1{new[0]}\\3', text)
-            if tmp != text:
-                log.LogDebug(f"'{old}' changed with '{new[0]}'")
-    return tmp
+            try:
+                passes.append(compile_replace_word(group))
+            except re.error:
+                # the rules can't share a regex (same group name...), one pass each
+                passes.extend(compile_replace_word([rule]) for rule in group)
+    return passes
+
+
+def compile_replace_word(group: list):
+    # The word is between separators: r'([\s_-])(word)(?=[\s_-])', the separator after
+    # it isn't consumed so the next word can use it. Each rule ends with an empty group,
+    # the last group of the match gives the rule.
+    alternatives = []
+    rules = {}
+    index = 1
+    for old, new in group:
+        rule = re.compile(fr'([\s_-])({old})')
+        index += rule.groups - 1
+        alternatives.append(fr'(?:{old})(?=[\s_-])()')
+        rules[index] = (rule, f'\\1{new}', old, new)
+    regex = re.compile(r'([\s_-])(?:' + "|".join(alternatives) + ")")
+
+    def replace(match):
+        rule, template, old, new = rules[match.lastindex]
+        log.LogDebug(f"'{old}' changed with '{new}'")
+        return rule.fullmatch(match.group(0)).expand(template)
+    return regex, replace
+
+
+def capture_groups(old: str):
+    try:
+        return re.compile(old).groups
+    except re.error:
+        return 0
+
+
+def compile_replace_word_groups(old: str, new: str):
+    # Same regex and template as before the merge, so the \1... of the replacement
+    # give the same result: \1 is the separator before the word, \2 the word.
+    rule = re.compile(fr'([\s_-])({old})([\s_-])')
+    template = f'\\1{new}\\3'
+
+    def replace(match):
+        log.LogDebug(f"'{old}' changed with '{new}'")
+        return match.expand(template)
+    return rule, replace
+
+
+def replace_any(rules: dict):
+    def replace(match):
+        log.LogDebug(f"'{match.group(0)}' changed with '{rules[match.group(0)]}'")
+        return rules[match.group(0)]
+    return replace
+
+
+def replace_text(text: str):
+    for regex, replacement in REPLACE_WORDS:
+        tmp = regex.sub(replacement, text)
+        if tmp != text and type(replacement) is str:
+            log.LogDebug(f"Regex matched: {text} -> {tmp}")
+        text = tmp
+    return text
+
+
+def field_value(scene_information: dict, field_name: str):
+    value = scene_information.get(field_name)
+    if value and FIELD_REPLACER.get(f"${field_name}"):
+        value = value.replace(FIELD_REPLACER[f"${field_name}"]["replace"], FIELD_REPLACER[f"${field_name}"]["with"])
+    return value
 
 
 def makeFilename(scene_information: dict, query: str) -> str:
-    new_filename = str(query)
-    for field in TEMPLATE_FIELD:
-        field_name = field.replace("$", "")
-        if field in new_filename:
-            if field == "$movie_scene":
-                if scene_information.get("movie_index"):
-                    new_filename = new_filename.replace(field, f"scene {scene_information['movie_index']}")
-                else:
-                    new_filename = re.sub(f'{{\\{field}.+}}|\\{field}', "", new_filename)
-            elif scene_information.get(field_name):
-                if field == "$performer":
-                    if re.search(r"\$performer[-\s_]*\$title", new_filename) and scene_information.get('title') and PREVENT_TITLE_PERF:
-                        if re.search(f"^{scene_information['performer'].lower()}", scene_information['title'].lower()):
-                            log.LogInfo("Ignoring the performer field because it's already in start of title")
-                            new_filename = re.sub(f'{{\\{field}.+}}|\\{field}', "", new_filename)
-                            continue
-                new_filename = new_filename.replace(field, scene_information[field_name])
-            else:
-                new_filename = re.sub(f'{{\\{field}.+}}|\\{field}', "", new_filename)
-            if FIELD_REPLACER.get(field):
-                new_filename = new_filename.replace(FIELD_REPLACER[field]["replace"], FIELD_REPLACER[field]["with"])
+    template = compile_template(query, TEMPLATE_FIELD)
+    ignore_performer = False
+    if PREVENT_TITLE_PERF and template.performer_before_title and scene_information.get('performer') and scene_information.get('title'):
+        if scene_information['title'].lower().startswith(scene_information['performer'].lower()):
+            log.LogInfo("Ignoring the performer field because it's already in start of title")
+            ignore_performer = True
+
+    def lookup(field_name):
+        if field_name == "movie_scene":
+            if scene_information.get("movie_index"):
+                return f"scene {scene_information['movie_index']}"
+            return None
+        if field_name == "performer" and ignore_performer:
+            return None
+        return field_value(scene_information, field_name)
+
+    new_filename = template.render(lookup, keep_braces=True)
 
     if FILENAME_REPLACEWORDS:
         new_filename = replace_text(new_filename)
@@ -653,18 +1221,16 @@ def makeFilename(scene_information: dict, query: str) -> str:
 
 
 def makePath(scene_information: dict, query: str) -> str:
-    new_filename = str(query)
-    new_filename = new_filename.replace("$performer", "$performer_path")
-    for field in TEMPLATE_FIELD:
-        field_name = field.replace("$", "")
-        if field in new_filename:
-            if scene_information.get(field_name):
-                new_filename = new_filename.replace(field, scene_information[field_name])
-            else:
-                new_filename = re.sub(f'{{\\{field}.+}}|\\{field}', "", new_filename)
-            if FIELD_REPLACER.get(field):
-                new_filename = new_filename.replace(FIELD_REPLACER[field]["replace"], FIELD_REPLACER[field]["with"])
-    new_filename = cleanup_text(new_filename)
+    template = compile_template(query, TEMPLATE_FIELD)
+
+    def lookup(field_name):
+        # the folder uses the performer chosen for the path
+        if field_name == "performer":
+            field_name = "performer_path"
+        return field_value(scene_information, field_name)
+
+    new_filename = template.render(lookup, keep_braces=True)
+    new_filename = cached_transform(cleanup_text, new_filename)
     return new_filename
 
 
@@ -694,6 +1260,11 @@ def create_new_filename(scene_info: dict, template: str):
     return new_filename
 
 
+def folder_name(name: str) -> str:
+    # Remove illegal character for Windows
+    return re.sub('[\\/:"*?<>|]+', '', name).strip()
+
+
 def remove_consecutive(liste: list):
     new_list = []
     for i in range(0, len(liste)):
@@ -715,9 +1286,9 @@ def create_new_path(scene_info: dict, template: dict):
             if not scene_info.get("studio_hierarchy"):
                 continue
             for p in scene_info["studio_hierarchy"]:
-                path_list.append(re.sub('[\\/:"*?<>|]+', '', p).strip())
+                path_list.append(cached_transform(folder_name, p))
         else:
-            path_list.append(re.sub('[\\/:"*?<>|]+', '', makePath(scene_info, part)).strip())
+            path_list.append(cached_transform(folder_name, makePath(scene_info, part)))
     # Remove blank, empty string
     path_split = [x for x in path_list if x]
     # The first character was a seperator, so put it back.
@@ -753,7 +1324,77 @@ def connect_db(path: str):
     return sqliteConnection
 
 
-def checking_duplicate_db(stash_db: sqlite3.Connection, scene_info: dict):
+def build_path_index(stash_db: sqlite3.Connection):
+    # Paths of every scene, loaded once for the bulk task. The duplicate checks become
+    # dict lookups instead of 'LIKE %...' queries scanning the whole table for each scene.
+    # Filenames are lowercase, like LIKE in SQLite.
+    path_index = {"path": {}, "filename": {}, "dir_filename": {}}
+    cursor = stash_db.cursor()
+    for scene_id, path in cursor.execute("SELECT id, path FROM scenes;"):
+        path_index_add(path_index, scene_id, path)
+    cursor.close()
+    log.LogDebug(f"[SQLITE] Path index: {len(path_index['path'])} paths")
+    return path_index
+
+
+def path_index_keys(path: str):
+    filename = os.path.basename(path).lower()
+    return {"path": path, "filename": filename, "dir_filename": (os.path.dirname(path).lower(), filename)}
+
+
+def path_index_add(path_index: dict, scene_id, path: str):
+    for index, key in path_index_keys(path).items():
+        path_index[index].setdefault(key, set()).add(int(scene_id))
+
+
+def path_index_remove(path_index: dict, scene_id, path: str):
+    for index, key in path_index_keys(path).items():
+        ids = path_index[index].get(key)
+        if ids:
+            ids.discard(int(scene_id))
+            if not ids:
+                del path_index[index][key]
+
+
+def path_index_move(path_index: dict, scene_id, old_path: str, new_path: str):
+    path_index_remove(path_index, scene_id, old_path)
+    path_index_add(path_index, scene_id, new_path)
+
+
+def index_duplicates(path_index: dict, scene_info: dict):
+    # Scenes in conflict with the new path: {"identical path": ids, "filename": ids, "same path": ids}
+    scene_id = int(scene_info['scene_id'])
+    filename = scene_info['new_filename'].lower()
+    return {
+        "identical path": path_index["dir_filename"].get((scene_info['current_directory'].lower(), filename), set()) - {scene_id},
+        "filename": path_index["filename"].get(filename, set()) - {scene_id},
+        "same path": path_index["path"].get(scene_info['final_path'], set()) - {scene_id}
+    }
+
+
+def checking_duplicate_index(path_index: dict, scene_info: dict):
+    duplicates = index_duplicates(path_index, scene_info)
+    # Looking for duplicate path
+    if duplicates["identical path"]:
+        for dupl_id in duplicates["identical path"]:
+            log.LogError(f"Identical path: [{dupl_id}]")
+        log.LogError("Duplicate path detected, check log!")
+        return 1
+
+    # Looking for duplicate filename
+    for dupl_id in duplicates["filename"]:
+        log.LogWarning(f"Duplicate filename: [{dupl_id}]")
+
+    # Looking for exact path
+    if duplicates["same path"]:
+        for dupl_id in duplicates["same path"]:
+            log.LogError(f"Same path: [{dupl_id}]")
+        return 1
+
+
+def checking_duplicate_db(stash_db: sqlite3.Connection, scene_info: dict, path_index=None):
+    if path_index is not None:
+        return checking_duplicate_index(path_index, scene_info)
     cursor = stash_db.cursor()
     # Looking for duplicate path
     cursor.execute("SELECT id FROM scenes WHERE path LIKE ? AND NOT id=?;", ["%" + scene_info['current_directory'] + "_" + scene_info['new_filename'], scene_info['scene_id']])
@@ -782,16 +1423,413 @@ def checking_duplicate_db(stash_db: sqlite3.Connection, scene_info: dict):
         return 1
 
 
-def db_rename(stash_db: sqlite3.Connection, scene_info):
-    cursor = stash_db.cursor()
-    # Database rename
-    cursor.execute("UPDATE scenes SET path=? WHERE id=?;", [scene_info['final_path'], scene_info['scene_id']])
-    stash_db.commit()
-    # Close DB
-    cursor.close()
+def database_locked(err: sqlite3.OperationalError):
+    # SQLITE_BUSY/SQLITE_LOCKED: Stash is writing (scan, generate...)
+    code = getattr(err, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xff in (5, 6)
+    return "locked" in str(err) or "busy" in str(err)
+
+
+def busy_delay(failures: int):
+    # exponential, with jitter so the tries don't follow the writes of Stash
+    delay = min(DB_BUSY_DELAY_MAX, DB_BUSY_DELAY * 2 ** failures)
+    return random.uniform(delay / 2, delay)
+
+
+class BatchWriter:
+    # Path updates, written after the file is moved. They are queued and saved in one
+    # short transaction every `batch_size` scenes or `interval` seconds (one fsync per
+    # batch instead of per scene, the database is only locked during the write).
+    # If Stash has locked the database (scan, generate...), the moved files stay in the
+    # queue and the write is tried again later (backoff with jitter), they are not moved back.
+    # The journal entries of the batch are marked done once it's committed.
+
+    def __init__(self, stash_db: sqlite3.Connection, batch_size: int, interval: float):
+        self.db = stash_db
+        self.batch_size = batch_size
+        self.interval = interval
+        # (new path, scene id, journal id, old path)
+        self.queue = []
+        self.first_pending = None
+        self.failures = 0
+        self.retry_at = 0
+
+    def add(self, scene_id, path: str, journal_id=None, old_path=None):
+        self.queue.append((path, scene_id, journal_id, old_path))
+        if self.first_pending is None:
+            self.first_pending = time.time()
+        if len(self.queue) >= self.batch_size or time.time() - self.first_pending >= self.interval:
+            self.flush()
+
+    def flush(self):
+        # One try, False if the database is locked (the paths stay queued)
+        if not self.queue:
+            return True
+        if time.time() < self.retry_at:
+            return False
+        # a locked database is tried again later, not waited for
+        busy_timeout = self.db.execute("PRAGMA busy_timeout").fetchone()[0]
+        self.db.execute(f"PRAGMA busy_timeout = {DB_BUSY_TRY_MS}")
+        try:
+            with phase_timer().phase("database commit"):
+                self.db.execute("BEGIN IMMEDIATE")
+                self.db.executemany("UPDATE scenes SET path=? WHERE id=?;", [(path, scene_id) for path, scene_id, _, _ in self.queue])
+                self.db.commit()
+        except sqlite3.OperationalError as err:
+            if self.db.in_transaction:
+                self.db.rollback()
+            if not database_locked(err):
+                raise
+            delay = busy_delay(self.failures)
+            self.failures += 1
+            self.retry_at = time.time() + delay
+            phase_timer().count("database locked")
+            log.LogDebug(f"[SQLITE] Database locked, {len(self.queue)} path(s) queued, next try in {delay:.2f}s")
+            return False
+        finally:
+            self.db.execute(f"PRAGMA busy_timeout = {busy_timeout}")
+        log.LogDebug(f"[SQLITE] Committed {len(self.queue)} path(s)")
+        journal_done([journal_id for _, _, journal_id, _ in self.queue])
+        self.queue = []
+        self.first_pending = None
+        self.failures = 0
+        self.retry_at = 0
+        return True
+
+    def commit(self, timeout=None):
+        # Everything queued, waiting up to timeout (db_busy_timeout) seconds for the lock.
+        # False if it's still locked: the paths are left to the journal (saved by the next run).
+        deadline = time.time() + (config.db_busy_timeout if timeout is None else timeout)
+        while not self.flush():
+            if time.time() >= deadline:
+                break
+            time.sleep(max(0, min(self.retry_at, deadline) - time.time()))
+        else:
+            return True
+        log.LogError(f"[SQLITE] The database is still locked, {len(self.queue)} moved file(s) not saved in Stash")
+        for path, scene_id, journal_id, old_path in self.queue:
+            if journal_id is not None:
+                log.LogWarning(f"[{scene_id}] Will be saved by the next run (journal): {old_path} -> {path}")
+            else:
+                log.LogError(f"[{scene_id}] Not saved in Stash, the file is now: {path} (was {old_path})")
+        return False
+
+
+def journal_connect():
+    # Write-ahead journal of the moves (rename_journal option), opened on first use.
+    # WAL + synchronous NORMAL: a commit survives the plugin being killed, without an fsync per scene.
+    global JOURNAL
+    if JOURNAL is None:
+        # the threads of the move scheduler write in it too (JOURNAL_LOCK)
+        JOURNAL = sqlite3.connect(JOURNAL_FILE, timeout=10, check_same_thread=False)
+        JOURNAL.execute("PRAGMA journal_mode=WAL")
+        JOURNAL.execute("PRAGMA synchronous=NORMAL")
+        JOURNAL.executescript(JOURNAL_SCHEMA)
+    return JOURNAL
+
+
+def journal_run():
+    # One run per process, created with its first move
+    global JOURNAL_RUN
+    if JOURNAL_RUN is None:
+        task = "hook" if PLUGIN_ARGS in (None, "daemon") else PLUGIN_ARGS
+        cursor = journal_connect().execute("INSERT INTO runs (task, pid, started) VALUES (?, ?, ?);", [task, os.getpid(), time.time()])
+        JOURNAL.commit()
+        JOURNAL_RUN = cursor.lastrowid
+    return JOURNAL_RUN
+
+
+def journal_intent(scene_id, old_path: str, new_path: str, kind="scene", undo_of=None):
+    # Saved before moving the file. Returns the id of the entry, None without journal.
+    if not config.rename_journal or DRY_RUN:
+        return None
+    start = time.perf_counter()
+    with JOURNAL_LOCK:
+        run_id = journal_run()
+        cursor = JOURNAL.execute("INSERT INTO entries (run_id, scene_id, kind, old_path, new_path, state, undo_of, updated) VALUES (?, ?, ?, ?, ?, 'intent', ?, ?);",
+                                 [run_id, int(scene_id), kind, old_path, new_path, undo_of, time.time()])
+        JOURNAL.commit()
+    phase_timer().add("journal", time.perf_counter() - start)
+    return cursor.lastrowid
+
+
+def journal_done(entry_ids: list, state="done"):
+    # 'done' once the file is moved and the database committed, 'failed' if nothing was moved.
+    entry_ids = [entry_id for entry_id in entry_ids if entry_id is not None]
+    if not entry_ids:
+        return
+    start = time.perf_counter()
+    now = time.time()
+    with JOURNAL_LOCK:
+        JOURNAL.executemany("UPDATE entries SET state=?, updated=? WHERE id=?;", [(state, now, entry_id) for entry_id in entry_ids])
+        if state == "done":
+            JOURNAL.executemany("UPDATE entries SET state='undone', updated=? WHERE id=(SELECT undo_of FROM entries WHERE id=?);", [(now, entry_id) for entry_id in entry_ids])
+        JOURNAL.commit()
+    phase_timer().add("journal", time.perf_counter() - start)
+
+
+def process_alive(pid: int):
+    if pid == os.getpid():
+        return True
+    if MODULE_PSUTIL:
+        return psutil.pid_exists(pid)
+    if os.name == "nt":
+        # os.kill would terminate it on Windows
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+        kernel32.CloseHandle(handle)
+        return code.value == 259  # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def journal_file_location(old_path: str, new_path: str, copied=False):
+    # Where the file is: the old path, the new path or None
+    # copied: the copy to another drive was complete (state 'copied', after its fsync)
+    old_exists, new_exists = os.path.isfile(old_path), os.path.isfile(new_path)
+    if old_exists and new_exists:
+        if not copied:
+            # not a copy of this move, nothing is deleted
+            log.LogWarning(f"[JOURNAL] A file was already at the new path, the move is rolled back ({new_path})")
+            return old_path
+        # only the removal of the source remained
+        os.remove(old_path)
+        directory_entries_moved(old_path, new_path)
+        return new_path
+    if new_exists:
+        return new_path
+    if old_exists:
+        return old_path
+    return None
+
+
+def journal_recover(own=False):
+    # Moves left unfinished by a plugin that was killed (or crashed): the database
+    # is set to where the file is. Moved: resumed ('done'), not moved: rolled back ('failed').
+    # own: also the moves of this process, for the hook worker between two hooks
+    # (a hook that gave up on the locked database)
+    if not config.rename_journal or DRY_RUN or not os.path.exists(JOURNAL_FILE):
+        return
+    if PLUGIN_ARGS and not own:
+        journal_prune()
+    rows = journal_connect().execute(
+        "SELECT entries.id, scene_id, kind, old_path, new_path, pid, state FROM entries JOIN runs ON runs.id=entries.run_id WHERE state IN ('intent', 'copied') ORDER BY entries.id;").fetchall()
+    alive = {}
+    rows = [row for row in rows if (own and row[5] == os.getpid()) or not alive.setdefault(row[5], process_alive(row[5]))]
+    if not rows:
+        return
+    log.LogWarning(f"[JOURNAL] {len(rows)} move(s) unfinished by a previous run, checking them")
+    stash_db = connect_db(STASH_DATABASE)
+    if stash_db is None:
+        return
+    # Stash may still be writing (why the paths weren't saved), it isn't waited for long
+    stash_db.execute(f"PRAGMA busy_timeout = {int(config.db_busy_timeout_hook * 1000)}")
+    try:
+        for entry_id, scene_id, kind, old_path, new_path, _, state in rows:
+            location = journal_file_location(old_path, new_path, state == "copied")
+            if location is None:
+                log.LogError(f"[JOURNAL] [{scene_id}] Can't find where the file is, fix it manually ({old_path} -> {new_path})")
+                journal_done([entry_id], "lost")
+                continue
+            if kind == "scene":
+                row = stash_db.execute("SELECT path FROM scenes WHERE id=?;", [scene_id]).fetchone()
+                if row is None or row[0] not in (old_path, new_path):
+                    log.LogWarning(f"[JOURNAL] [{scene_id}] The scene has changed since, ignored ({old_path} -> {new_path})")
+                    journal_done([entry_id], "lost")
+                    continue
+                if row[0] != location:
+                    stash_db.execute("UPDATE scenes SET path=? WHERE id=?;", [location, scene_id])
+                    stash_db.commit()
+            if location == new_path:
+                log.LogInfo(f"[JOURNAL] [{scene_id}] Move completed ({new_path})")
+                journal_done([entry_id])
+            else:
+                log.LogInfo(f"[JOURNAL] [{scene_id}] Move rolled back ({old_path})")
+                journal_done([entry_id], "failed")
+    except sqlite3.OperationalError as err:
+        if not database_locked(err):
+            raise
+        # the entries stay unfinished, checked again by the next run
+        log.LogWarning("[JOURNAL] The database is locked, the unfinished moves are left for the next run")
+    finally:
+        stash_db.close()
+
 
+def journal_prune():
+    # Forget the finished runs after JOURNAL_KEEP_DAYS
+    limit = time.time() - JOURNAL_KEEP_DAYS * 86400
+    journal_connect().execute("DELETE FROM entries WHERE run_id IN (SELECT id FROM runs WHERE started<?) AND state NOT IN ('intent', 'copied');", [limit])
+    JOURNAL.execute("DELETE FROM runs WHERE started<? AND id NOT IN (SELECT run_id FROM entries);", [limit])
+    JOURNAL.commit()
+
+
+def journal_undo():
+    # Move back the files of the last task run (not the hooks), newest first.
+    # The database is updated by batch and the undo is journaled like any move.
+    global VACATED_FOLDERS
+    if not config.rename_journal or not os.path.exists(JOURNAL_FILE):
+        exit_plugin(err="Nothing to undo, the journal is empty (rename_journal option).")
+    run = journal_connect().execute(
+        "SELECT id, task, started FROM runs WHERE task NOT IN ('hook', 'undo') AND id IN (SELECT run_id FROM entries WHERE state='done') ORDER BY id DESC LIMIT 1;").fetchone()
+    if run is None:
+        exit_plugin("Nothing to undo")
+    run_id, task, started = run
+    entries = JOURNAL.execute("SELECT id, scene_id, kind, old_path, new_path FROM entries WHERE run_id=? AND state='done' ORDER BY id DESC;", [run_id]).fetchall()
+    log.LogInfo(f"Undoing {len(entries)} move(s) of the task '{task}' ({time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started))})")
+    if DRY_RUN:
+        if LOGFILE:
+            with open(DRY_RUN_FILE, 'a', encoding='utf-8') as f:
+                for _, scene_id, _, old_path, new_path in entries:
+                    f.write(f"{scene_id}|{new_path}|{old_path}\n")
+        return
+    stash_db = connect_db(STASH_DATABASE)
+    if stash_db is None:
+        exit_plugin()
+    db_writer = BatchWriter(stash_db, config.db_batch_size, config.db_batch_interval)
+    VACATED_FOLDERS = set()
+    for progress, (entry_id, scene_id, kind, old_path, new_path) in enumerate(entries):
+        log.LogProgress(progress / len(entries))
+        if not os.path.isfile(new_path) or os.path.exists(old_path):
+            log.LogWarning(f"[{scene_id}] Skipped, the file has changed since ({new_path})")
+            continue
+        if kind == "scene":
+            row = stash_db.execute("SELECT path FROM scenes WHERE id=?;", [scene_id]).fetchone()
+            if row is None or row[0] != new_path:
+                log.LogWarning(f"[{scene_id}] Skipped, the scene has changed since ({new_path})")
+                continue
+        undo_id = journal_intent(scene_id, new_path, old_path, kind, undo_of=entry_id)
+        try:
+            os.makedirs(os.path.dirname(old_path), exist_ok=True)
+            MOVE_PROGRESS[:] = [progress / len(entries), 1 / len(entries)]
+            move_file(new_path, old_path, undo_id)
+        except Exception as err:
+            journal_done([undo_id], "failed")
+            log.LogError(f"[{scene_id}] Can't move back the file ({new_path}) - err: {err}")
+            continue
+        if kind == "scene":
+            db_writer.add(scene_id, old_path, undo_id, new_path)
+        else:
+            journal_done([undo_id])
+        log.LogDebug(f"[{scene_id}] Moved back ({new_path} -> {old_path})")
+        vacated_folder(os.path.dirname(new_path))
+    db_writer.commit()
+    stash_db.close()
+    log.LogInfo("[SQLITE] Database closed!")
+    prune_vacated_folders()
+
+
+def same_device(src_stat: os.stat_result, directory: str):
+    try:
+        return src_stat.st_dev == os.stat(directory).st_dev
+    except OSError:
+        return False
 
-def file_rename(scene_info: dict, template: dict):
+
+def move_file(src: str, dst: str, journal_id=None):
+    src_stat = os.stat(src)
+    # Same filesystem: a rename, nothing is copied.
+    if same_device(src_stat, os.path.dirname(dst)):
+        try:
+            os.rename(src, dst)
+            directory_entries_moved(src, dst)
+            phase_timer().count("bytes moved", src_stat.st_size)
+            return
+        except OSError as err:
+            # bind mounts of the same filesystem can still refuse it
+            if err.errno != errno.EXDEV:
+                raise
+    # The source is deleted after the copy: not while a process (ffmpeg...) is still writing it.
+    # On the same drive, a rename doesn't change the file it writes.
+    if PROC_FD:
+        writers = proc_writers(src)
+        if writers:
+            raise OSError(errno.EBUSY, f"Opened for writing by another process (pid {', '.join(map(str, writers))})", src)
+    copy_resumable(src, dst, journal_id)
+    os.remove(src)
+    directory_entries_moved(src, dst)
+    phase_timer().count("bytes moved", src_stat.st_size)
+    phase_timer().count("bytes copied", src_stat.st_size)
+
+
+def resume_offset(src: str, part: str, size: int):
+    # Keep a partial copy only if its last bytes are the same as the source.
+    done = os.path.getsize(part)
+    if done == 0 or done > size:
+        return 0
+    check = min(done, COPY_RESUME_CHECK)
+    with open(src, 'rb') as f_src, open(part, 'rb') as f_part:
+        f_src.seek(done - check)
+        f_part.seek(done - check)
+        if f_src.read(check) == f_part.read(check):
+            return done
+    return 0
+
+
+def copy_chunk(method: str, f_src, f_dst, offset: int, count: int):
+    if method == "copy_file_range":
+        return os.copy_file_range(f_src.fileno(), f_dst.fileno(), count, offset, offset)
+    if method == "sendfile":
+        f_dst.seek(offset)
+        return os.sendfile(f_dst.fileno(), f_src.fileno(), offset, count)
+    f_src.seek(offset)
+    data = f_src.read(count)
+    f_dst.seek(offset)
+    f_dst.write(data)
+    return len(data)
+
+
+def copy_resumable(src: str, dst: str, journal_id=None):
+    # Copy to '<dst>.part' then rename it, so dst only exists once complete.
+    # The journal entry is 'copied' before the rename: the source can be deleted by journal_recover.
+    part = dst + ".part"
+    size = os.path.getsize(src)
+    offset = 0
+    if os.path.exists(part):
+        offset = resume_offset(src, part, size)
+        if offset:
+            log.LogInfo(f"[OS] Resuming the copy at {offset * 100 // max(size, 1)}% ({part})")
+    log.LogDebug(f"[OS] Copying to another drive ({src} -> {dst})")
+    methods = list(COPY_METHODS)
+    last_progress = time.time()
+    start, width = MOVE_PROGRESS
+    with open(src, 'rb', buffering=0) as f_src, open(part, 'r+b' if offset else 'wb', buffering=0) as f_dst:
+        f_dst.truncate(offset)
+        while offset < size:
+            count = min(COPY_CHUNK_SIZE, size - offset)
+            try:
+                copied = copy_chunk(methods[0], f_src, f_dst, offset, count)
+            except OSError as err:
+                # not supported for these files, use the next method
+                if err.errno not in COPY_FALLBACK_ERRNO or len(methods) == 1:
+                    raise
+                log.LogDebug(f"[OS] {methods[0]} failed ({err}), using {methods[1]}")
+                methods.pop(0)
+                continue
+            if copied == 0:
+                raise OSError(f"Source file is shorter than expected ({src})")
+            offset += copied
+            # the moves done by the scheduler threads only have the progress of the task
+            if time.time() - last_progress >= 1 and threading.current_thread() is threading.main_thread():
+                last_progress = time.time()
+                log.LogProgress(start + width * offset / size)
+        os.fsync(f_dst.fileno())
+    shutil.copystat(src, part)
+    journal_done([journal_id], "copied")
+    os.replace(part, dst)
+
+
+def file_rename(scene_info: dict, template: dict, journal_id=None):
     # OS Rename
     if not os.path.isfile(scene_info['current_path']):
         log.LogWarning(f"[OS] File doesn't exist in your Disk/Drive ({scene_info['current_path']})")
@@ -802,9 +1840,11 @@ def file_rename(scene_info: dict, template: dict):
         log.LogInfo(f"Creating folder because it don't exist ({new_dir})")
         os.makedirs(new_dir)
     try:
-        shutil.move(scene_info['current_path'], scene_info['final_path'])
-    except PermissionError as err:
-        if "[WinError 32]" in str(err) and MODULE_PSUTIL:
+        move_file(scene_info['current_path'], scene_info['final_path'], journal_id)
+    except OSError as err:
+        if not file_busy(err) and not isinstance(err, PermissionError):
+            raise
+        if file_busy(err) and MODULE_PSUTIL:
             log.LogWarning("A process is using this file (Probably FFMPEG), trying to find it ...")
             # Find which process accesses the file, it's ffmpeg for sure...
             process_use = has_handle(scene_info['current_path'], PROCESS_ALLRESULT)
@@ -812,18 +1852,21 @@ def file_rename(scene_info: dict, template: dict):
                 # Terminate the process then try again to rename
                 log.LogDebug(f"Process that uses this file: {process_use}")
                 if PROCESS_KILL:
-                    p = psutil.Process(process_use.pid)
-                    p.terminate()
-                    p.wait(10)
+                    for p in (process_use if isinstance(process_use, list) else [process_use]):
+                        p.terminate()
+                        p.wait(10)
                     # If process is not terminated, this will create an error again.
                     try:
-                        shutil.move(scene_info['current_path'], scene_info['final_path'])
+                        move_file(scene_info['current_path'], scene_info['final_path'], journal_id)
                     except Exception as err:
                         log.LogError(f"Something still prevents renaming the file. {err}")
                         return 1
                 else:
                     log.LogError("A process prevents renaming the file.")
                     return 1
+            else:
+                log.LogError(f"Something prevents renaming the file. {err}")
+                return 1
         else:
             log.LogError(f"Something prevents renaming the file. {err}")
             return 1
@@ -835,17 +1878,9 @@ def file_rename(scene_info: dict, template: dict):
                 with open(LOGFILE, 'a', encoding='utf-8') as f:
                     f.write(f"{scene_info['scene_id']}|{scene_info['current_path']}|{scene_info['final_path']}|{scene_info['oshash']}\n")
             except Exception as err:
-                shutil.move(scene_info['final_path'], scene_info['current_path'])
+                move_file(scene_info['final_path'], scene_info['current_path'])
                 log.LogError(f"Restoring the original path, error writing the logfile: {err}")
                 return 1
-        if REMOVE_EMPTY_FOLDER:
-            with os.scandir(scene_info['current_directory']) as it:
-                if not any(it):
-                    log.LogInfo(f"Removing empty folder ({scene_info['current_directory']})")
-                    try:
-                        os.rmdir(scene_info['current_directory'])
-                    except Exception as err:
-                        log.logWarning(f"Fail to delete empty folder {scene_info['current_directory']} - {err}")
     else:
         # I don't think it's possible.
         log.LogError(f"[OS] Failed to rename the file ? {scene_info['final_path']}")
@@ -855,29 +1890,340 @@ def file_rename(scene_info: dict, template: dict):
             graphql_removeScenesTag([scene_info['scene_id']], template["path"]["opt_details"]["clean_tag"])
 
 
+def directory_entries(directory: str):
+    # Files of a folder, with one scandir: sorted list of (normcase(name), name), so the
+    # files starting with a name are found with a bisect. The last folders are kept (bulk task).
+    with DIR_ENTRIES_LOCK:
+        entries = DIR_ENTRIES.get(directory)
+        if entries is not None:
+            DIR_ENTRIES.move_to_end(directory)
+            return entries
+    entries = []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_file():
+                    entries.append((os.path.normcase(entry.name), entry.name))
+    except OSError as err:
+        log.LogDebug(f"Can't list the folder {directory} ({err})")
+    entries.sort()
+    with DIR_ENTRIES_LOCK:
+        DIR_ENTRIES[directory] = entries
+        if len(DIR_ENTRIES) > DIR_ENTRIES_MAX:
+            DIR_ENTRIES.popitem(last=False)
+    return entries
+
+
+def directory_entries_moved(src: str, dst: str):
+    # keep the listed folders up to date
+    src_dir, src_name = os.path.split(src)
+    dst_dir, dst_name = os.path.split(dst)
+    with DIR_ENTRIES_LOCK:
+        src_entries = DIR_ENTRIES.get(src_dir)
+        dst_entries = DIR_ENTRIES.get(dst_dir)
+    # a folder is only on one drive, the moves of a drive are done one by one
+    if src_entries is not None:
+        entry = (os.path.normcase(src_name), src_name)
+        i = bisect.bisect_left(src_entries, entry)
+        if i < len(src_entries) and src_entries[i] == entry:
+            del src_entries[i]
+    if dst_entries is not None:
+        entry = (os.path.normcase(dst_name), dst_name)
+        i = bisect.bisect_left(dst_entries, entry)
+        if i == len(dst_entries) or dst_entries[i] != entry:
+            dst_entries.insert(i, entry)
+
+
+def vacated_folder(directory: str):
+    # remove_emptyfolder. The tasks collect the folders and remove them once at the end.
+    if not REMOVE_EMPTY_FOLDER:
+        return
+    if VACATED_FOLDERS is not None:
+        VACATED_FOLDERS.add(directory)
+    else:
+        prune_empty_folders([directory])
+
+
+def inside_stash(directory: str):
+    key = os.path.normcase(directory)
+    return any(key.startswith(root + os.sep) for root in STASH_ROOTS)
+
+
+def prune_empty_folders(directories):
+    # Bottom-up (deepest first), so a parent is tried after its subfolders. rmdir itself
+    # refuses a folder that isn't empty, nothing is listed. When a folder is removed, its
+    # parent is tried too, up to the library folder of Stash (never removed).
+    heap = [(-directory.count(os.sep), directory) for directory in {os.path.normpath(d) for d in directories}]
+    heapq.heapify(heap)
+    seen = {directory for _, directory in heap}
+    removed = 0
+    while heap:
+        _, directory = heapq.heappop(heap)
+        if os.path.normcase(directory) in STASH_ROOTS:
+            continue
+        try:
+            os.rmdir(directory)
+        except OSError as err:
+            if err.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                log.LogWarning(f"Fail to delete empty folder {directory} - {err}")
+            continue
+        log.LogInfo(f"Removed empty folder ({directory})")
+        DIR_ENTRIES.pop(directory, None)
+        removed += 1
+        parent = os.path.dirname(directory)
+        if parent not in seen and inside_stash(parent):
+            seen.add(parent)
+            heapq.heappush(heap, (-parent.count(os.sep), parent))
+    return removed
+
+
+def prune_vacated_folders():
+    if VACATED_FOLDERS:
+        log.LogDebug(f"Checking {len(VACATED_FOLDERS)} folder(s) left by the moves")
+        prune_empty_folders(VACATED_FOLDERS)
+        VACATED_FOLDERS.clear()
+
+
+def associated_files(scene_info: dict):
+    # (current path, new path) of the associated files, taken from the plan file if there is one.
+    # Every file of the folder named like the video followed by one of the patterns (.srt, .en.srt, -thumb.jpg...)
+    if scene_info.get("associated") is not None:
+        return scene_info["associated"]
+    if not ASSOCIATED_RE:
+        return []
+    directory = scene_info['current_directory']
+    video = scene_info['current_filename']
+    stem, ext = os.path.splitext(video)
+    new_stem = os.path.splitext(scene_info['final_path'])[0]
+    entries = directory_entries(directory)
+    key_stem, key_ext = os.path.normcase(stem), os.path.normcase(ext)
+    # the files starting with the video name, next to each other in the sorted listing
+    candidates = []
+    i = bisect.bisect_left(entries, (key_stem,))
+    while i < len(entries) and entries[i][0].startswith(key_stem):
+        if entries[i][1] != video:
+            candidates.append(entries[i])
+        i += 1
+    # a longer video name is another scene (video.part2.srt belongs to video.part2.mp4, not to video.mp4)
+    other_stems = [os.path.splitext(key)[0] for key, name in candidates if is_video(key, key_ext)]
+    other_stems = [o for o in other_stems if len(o) > len(stem)]
+    files = []
+    for key, name in candidates:
+        suffix = name[len(stem):]
+        if not ASSOCIATED_RE.match(suffix) or any(key.startswith(o) for o in other_stems):
+            continue
+        files.append((os.path.join(directory, name), new_stem + suffix))
+    return files
+
+
+def is_video(filename: str, video_ext: str):
+    # extension of the scene's video or one of Stash's video extensions
+    ext = os.path.splitext(filename)[1]
+    return ext == video_ext or ext[1:].lower() in VIDEO_EXTENSIONS
+
+
 def associated_rename(scene_info: dict):
-    if ASSOCIATED_EXT:
-        for ext in ASSOCIATED_EXT:
-            p = os.path.splitext(scene_info['current_path'])[0] + "." + ext
-            p_new = os.path.splitext(scene_info['final_path'])[0] + "." + ext
-            if os.path.isfile(p):
-                try:
-                    shutil.move(p, p_new)
-                except Exception as err:
-                    log.LogError(f"Something prevents renaming this file '{p}' - err: {err}")
-                    continue
-            if os.path.isfile(p_new):
-                log.LogInfo(f"[OS] Associate file renamed ({p_new})")
-                if LOGFILE:
-                    try:
-                        with open(LOGFILE, 'a', encoding='utf-8') as f:
-                            f.write(f"{scene_info['scene_id']}|{p}|{p_new}\n")
-                    except Exception as err:
-                        shutil.move(p_new, p)
-                        log.LogError(f"Restoring the original name, error writing the logfile: {err}")
+    # the files of a plan file may have changed since
+    from_plan = scene_info.get("associated") is not None
+    for p, p_new in associated_files(scene_info):
+        if from_plan and not os.path.isfile(p):
+            continue
+        journal_id = journal_intent(scene_info['scene_id'], p, p_new, "associated")
+        try:
+            move_file(p, p_new, journal_id)
+        except Exception as err:
+            journal_done([journal_id], "failed")
+            log.LogError(f"Something prevents renaming this file '{p}' - err: {err}")
+            continue
+        journal_done([journal_id])
+        log.LogInfo(f"[OS] Associate file renamed ({p_new})")
+        if LOGFILE:
+            try:
+                with open(LOGFILE, 'a', encoding='utf-8') as f:
+                    f.write(f"{scene_info['scene_id']}|{p}|{p_new}\n")
+            except Exception as err:
+                move_file(p_new, p)
+                journal_done([journal_id], "failed")
+                log.LogError(f"Restoring the original name, error writing the logfile: {err}")
 
 
-def renamer(scene_id, db_conn=None):
+def existing_folder(directory: str):
+    # the folder, or its first parent that exists (the move creates the others)
+    while not os.path.isdir(directory):
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+    return directory
+
+
+def init_move_worker():
+    PLAN_WORKER.timer = PhaseTimer()
+
+
+def move_job(scene_information: dict, template: dict, journal_id=None):
+    # The file and its associated files, in a thread of the scheduler (or inline).
+    # Returns (error, timings of the thread), the rest is done by MoveScheduler.finish.
+    try:
+        with phase_timer().phase("file move"):
+            err = file_rename(scene_information, template, journal_id)
+        if err:
+            err = "rename"
+        else:
+            with phase_timer().phase("associated files"):
+                associated_rename(scene_information)
+    except Exception as e:
+        err = str(e)
+    if getattr(PLAN_WORKER, "timer", None):
+        return err, PLAN_WORKER.timer.take()
+    return err, None
+
+
+class MoveScheduler:
+    # Moves of a task, grouped by (source drive, destination drive). The moves of a pair
+    # are done in the order of the scenes, and a drive is only used by one move at a time:
+    # two pairs run in parallel (move_workers) only if they have no drive in common.
+    # The threads only move the files, the path index and the database are updated
+    # here (main thread) once a move is finished.
+    # Before a move to another drive, its size is taken from the free space of that drive.
+    # With 1 worker, each move is done when it's submitted (in order, as before).
+
+    def __init__(self, workers: int, path_index: dict, db_writer: BatchWriter):
+        self.path_index = path_index
+        self.db_writer = db_writer
+        self.pool = None
+        if workers > 1:
+            log.LogDebug(f"Moving the files on {workers} pairs of drives at most")
+            self.pool = multiprocessing.pool.ThreadPool(workers, initializer=init_move_worker)
+        self.max_pending = workers * 8
+        # (source device, destination device) -> moves waiting
+        self.lanes = {}
+        # devices used by a running move
+        self.busy = set()
+        self.pending = 0
+        self.finished = queue.Queue()
+        # normcase(current path) -> move not finished yet
+        self.sources = {}
+        # device -> free bytes, minus the moves submitted
+        self.free = {}
+        self.failed = set()
+
+    def submit(self, scene_information: dict, template: dict, journal_id=None):
+        # False if there isn't enough space on the destination drive (nothing is done).
+        try:
+            src_stat = os.stat(scene_information['current_path'])
+            src_dev, size = src_stat.st_dev, src_stat.st_size
+        except OSError:
+            # file_rename tells it's missing
+            src_dev, size = None, 0
+        new_directory = existing_folder(os.path.dirname(scene_information['final_path']))
+        try:
+            dst_dev = os.stat(new_directory).st_dev
+        except OSError:
+            dst_dev = None
+        if src_dev == dst_dev:
+            # a rename, nothing is copied
+            size = 0
+        elif not self.reserve(dst_dev, new_directory, size, scene_information['scene_id']):
+            return False
+        move = {
+            "scene_information": scene_information,
+            "template": template,
+            "journal_id": journal_id,
+            "devices": (src_dev, dst_dev),
+            "size": size
+        }
+        self.sources[os.path.normcase(scene_information['current_path'])] = move
+        if self.pool is None:
+            self.finish(move, move_job(scene_information, template, journal_id))
+            return True
+        self.lanes.setdefault(move["devices"], collections.deque()).append(move)
+        self.pending += 1
+        self.dispatch()
+        # limit the moves waiting, so the scenes are still read page by page
+        while self.pending >= self.max_pending:
+            self.collect()
+        return True
+
+    def reserve(self, device, directory: str, size: int, scene_id):
+        if device not in self.free:
+            try:
+                self.free[device] = shutil.disk_usage(directory).free
+            except OSError as err:
+                log.LogDebug(f"Can't get the free space of {directory} ({err})")
+                self.free[device] = None
+        free = self.free[device]
+        if free is None:
+            return True
+        if size + MOVE_FREE_MARGIN > free:
+            log.LogError(f"[{scene_id}] Not enough space on the drive of {directory} ({size // 2**20} MiB needed, {free // 2**20} MiB left)")
+            phase_timer().count("moves without space")
+            return False
+        self.free[device] = free - size
+        return True
+
+    def dispatch(self):
+        # start the next move of each pair whose drives are free
+        for devices in list(self.lanes):
+            if not self.busy.isdisjoint(devices):
+                continue
+            lane = self.lanes[devices]
+            move = lane.popleft()
+            if not lane:
+                del self.lanes[devices]
+            self.busy.update(devices)
+            self.pool.apply_async(move_job, (move["scene_information"], move["template"], move["journal_id"]),
+                                  callback=lambda result, move=move: self.finished.put((move, result)),
+                                  error_callback=lambda err, move=move: self.finished.put((move, (str(err), None))))
+
+    def collect(self):
+        # wait for a move, then start the next ones
+        move, result = self.finished.get()
+        self.busy.difference_update(move["devices"])
+        self.pending -= 1
+        self.finish(move, result)
+        self.dispatch()
+
+    def wait_for(self, path: str):
+        # A scene of the task is moving away from this path: wait until it's done,
+        # the duplicate check needs to know if the path is free.
+        while os.path.normcase(path) in self.sources:
+            self.collect()
+
+    def finish(self, move: dict, result: tuple):
+        err, timings = result
+        if timings:
+            TIMER.merge(timings)
+        scene_information = move["scene_information"]
+        scene_id = scene_information['scene_id']
+        self.sources.pop(os.path.normcase(scene_information['current_path']), None)
+        src_dev, dst_dev = move["devices"]
+        if err:
+            journal_done([move["journal_id"]], "failed")
+            # the path is taken again
+            path_index_move(self.path_index, scene_id, scene_information['final_path'], scene_information['current_path'])
+            if self.free.get(dst_dev) is not None:
+                self.free[dst_dev] += move["size"]
+            self.failed.add(scene_id)
+            log.LogError(f"Error during database operation ({err})")
+            return
+        if self.free.get(src_dev) is not None:
+            self.free[src_dev] += move["size"]
+        with phase_timer().phase("database"):
+            self.db_writer.add(scene_id, scene_information['final_path'], move["journal_id"], scene_information['current_path'])
+        vacated_folder(scene_information['current_directory'])
+
+    def close(self):
+        while self.pending:
+            self.collect()
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+
+
+def plan_rename(scene_id):
+    # Compute the new path of a scene, without touching the disk or the database.
+    # Returns None if there is nothing to do.
     option_dryrun = False
     if type(scene_id) is dict:
         stash_scene = scene_id
@@ -885,14 +2231,16 @@ def renamer(scene_id, db_conn=None):
     elif type(scene_id) is int:
         stash_scene = graphql_getScene(scene_id)
 
+    phase_timer().count("scenes")
     if config.only_organized and not stash_scene['organized'] and not PATH_NON_ORGANIZED:
         log.LogDebug(f"[{scene_id}] Scene ignored (not organized)")
         return
 
     # Tags > Studios > Default
     template = {}
-    template["filename"] = get_template_filename(stash_scene)
-    template["path"] = get_template_path(stash_scene)
+    with phase_timer().phase("template"):
+        template["filename"] = get_template_filename(stash_scene)
+        template["path"] = get_template_path(stash_scene)
     if not template["path"].get("destination"):
         if config.p_use_default_template:
             log.LogDebug("[PATH] Using default template")
@@ -913,8 +2261,8 @@ def renamer(scene_id, db_conn=None):
         return
 
     #log.LogDebug("Using this template: {}".format(filename_template))
+    render_start = time.perf_counter()
     scene_information = extract_info(stash_scene, template)
-    log.LogDebug(f"[{scene_id}] Scene information: {scene_information}")
     log.LogDebug(f"[{scene_id}] Template: {template}")
 
     scene_information['scene_id'] = scene_id
@@ -926,13 +2274,15 @@ def renamer(scene_id, db_conn=None):
         scene_information['new_directory'] = create_new_path(scene_information, template)
     else:
         scene_information['new_directory'] = scene_information['current_directory']
+    phase_timer().add("render", time.perf_counter() - render_start)
+    # the fields used by the templates
+    log.LogDebug(f"[{scene_id}] Scene information: {scene_information}")
     scene_information['final_path'] = os.path.join(scene_information['new_directory'], scene_information['new_filename'])
+    plan = {"scene_information": scene_information, "template": template, "dry_run": option_dryrun, "path_too_long": False}
     # check length of path
     if check_longpath(scene_information['final_path']):
-        if (DRY_RUN or option_dryrun) and LOGFILE:
-            with open(DRY_RUN_FILE, 'a', encoding='utf-8') as f:
-                f.write(f"[LENGTH LIMIT] {scene_information['scene_id']}|{scene_information['final_path']}\n")
-        return
+        plan["path_too_long"] = True
+        return plan
 
     #log.LogDebug(f"Filename: {scene_information['current_filename']} -> {scene_information['new_filename']}")
     #log.LogDebug(f"Path: {scene_information['current_directory']} -> {scene_information['new_directory']}")
@@ -953,8 +2303,31 @@ def renamer(scene_id, db_conn=None):
         else:
             log.LogDebug(f"[OLD filename] {scene_information['current_filename']}")
             log.LogDebug(f"[NEW filename] {scene_information['new_filename']}")
+    return plan
+
+
+def apply_rename(plan: dict, db_conn=None, path_index=None, db_writer=None, mover=None):
+    # Execute a plan from plan_rename (duplicate check, move, database update).
+    # path_index (bulk): paths of the scenes, kept up to date with the renames of the run.
+    # db_writer (tasks): BatchWriter used instead of committing each scene.
+    # mover (tasks): MoveScheduler, the move is submitted to it and finished later (True = submitted).
+    scene_information = plan["scene_information"]
+    template = plan["template"]
+    option_dryrun = plan["dry_run"]
+    if plan["path_too_long"]:
+        if (DRY_RUN or option_dryrun) and LOGFILE:
+            with open(DRY_RUN_FILE, 'a', encoding='utf-8') as f:
+                f.write(f"[LENGTH LIMIT] {scene_information['scene_id']}|{scene_information['final_path']}\n")
+        return
 
     if (DRY_RUN or option_dryrun) and LOGFILE:
+        if path_index is not None:
+            # also catch 2 scenes of this run going to the same path
+            if checking_duplicate_index(path_index, scene_information):
+                with open(DRY_RUN_FILE, 'a', encoding='utf-8') as f:
+                    f.write(f"[DUPLICATE] {scene_information['scene_id']}|{scene_information['final_path']}\n")
+                return
+            path_index_move(path_index, scene_information['scene_id'], scene_information['current_path'], scene_information['final_path'])
         with open(DRY_RUN_FILE, 'a', encoding='utf-8') as f:
             f.write(f"{scene_information['scene_id']}|{scene_information['current_path']}|{scene_information['final_path']}\n")
         return
@@ -966,27 +2339,56 @@ def renamer(scene_id, db_conn=None):
     else:
         stash_db = db_conn
     try:
+        if mover:
+            mover.wait_for(scene_information['final_path'])
         # check if there is already a file where the new path is
-        err = checking_duplicate_db(stash_db, scene_information)
+        with phase_timer().phase("duplicate check"):
+            err = checking_duplicate_db(stash_db, scene_information, path_index)
         if err:
             raise Exception("duplicate")
+        # saved before the move, if the plugin is killed the next run finishes it
+        journal_id = journal_intent(scene_information['scene_id'], scene_information['current_path'], scene_information['final_path'])
+        if mover:
+            # the next scenes can't take this path, given back if the move fails
+            path_index_move(path_index, scene_information['scene_id'], scene_information['current_path'], scene_information['final_path'])
+            if not mover.submit(scene_information, template, journal_id):
+                path_index_move(path_index, scene_information['scene_id'], scene_information['final_path'], scene_information['current_path'])
+                journal_done([journal_id], "failed")
+                raise Exception("not enough space")
+            return True
         # rename file on your disk
-        err = file_rename(scene_information, template)
+        with phase_timer().phase("file move"):
+            try:
+                err = file_rename(scene_information, template, journal_id)
+            except Exception:
+                journal_done([journal_id], "failed")
+                raise
         if err:
+            journal_done([journal_id], "failed")
             raise Exception("rename")
         # rename file on your db
-        try:
-            db_rename(stash_db, scene_information)
-        except Exception as err:
-            log.LogError(f"error when trying to update the database ({err}), revert the move...")
-            tmp = scene_information['final_path']
-            scene_information['final_path'] = scene_information['current_path']
-            scene_information['current_path'] = tmp
-            scene_information['current_directory'] = os.path.dirname(scene_information['current_path'])
-            err = file_rename(scene_information, template)
-            if err:
-                raise Exception("rename")
-            raise Exception("database update")
+        if db_writer:
+            with phase_timer().phase("database"):
+                db_writer.add(scene_information['scene_id'], scene_information['final_path'], journal_id, scene_information['current_path'])
+        else:
+            with phase_timer().phase("database"):
+                db_writer = BatchWriter(stash_db, 1, 0)
+                db_writer.add(scene_information['scene_id'], scene_information['final_path'], journal_id, scene_information['current_path'])
+                # Stash waits for the hook, the journal saves the path on the next run
+                saved = db_writer.commit(config.db_busy_timeout_hook if journal_id is not None else None)
+            if not saved and journal_id is None:
+                # no journal to save it later
+                log.LogError("Can't update the database, revert the move...")
+                tmp = scene_information['final_path']
+                scene_information['final_path'] = scene_information['current_path']
+                scene_information['current_path'] = tmp
+                scene_information['current_directory'] = os.path.dirname(scene_information['current_path'])
+                err = file_rename(scene_information, template)
+                if err:
+                    raise Exception("rename")
+                raise Exception("database update")
+        if path_index is not None:
+            path_index_move(path_index, scene_information['scene_id'], scene_information['current_path'], scene_information['final_path'])
     except Exception as err:
         log.LogError(f"Error during database operation ({err})")
         if not db_conn:
@@ -996,12 +2398,209 @@ def renamer(scene_id, db_conn=None):
     if not db_conn:
         stash_db.close()
         log.LogInfo("[SQLITE] Database updated and closed!")
-    associated_rename(scene_information)
+    with phase_timer().phase("associated files"):
+        associated_rename(scene_information)
+    vacated_folder(scene_information['current_directory'])
+    return True
+
+
+def renamer(scene_id, db_conn=None):
+    plan = plan_rename(scene_id)
+    if plan:
+        apply_rename(plan, db_conn)
+
+
+def write_plan_entry(plan_file, plan: dict, path_index: dict):
+    # One JSON line per scene, everything needed by apply_plan_file
+    scene_information = plan["scene_information"]
+    template = plan["template"]
+    conflicts = []
+    if plan["path_too_long"]:
+        conflicts.append("path too long")
+    else:
+        for kind, dupl_ids in index_duplicates(path_index, scene_information).items():
+            if kind != "filename":
+                conflicts.extend(f"{kind} as scene {dupl_id}" for dupl_id in sorted(dupl_ids))
+        if not conflicts:
+            # the next scenes of the plan can't use this path
+            path_index_move(path_index, scene_information['scene_id'], scene_information['current_path'], scene_information['final_path'])
+    clean_tag = []
+    if template.get("path") and "clean_tag" in template["path"]["option"]:
+        clean_tag = template["path"]["opt_details"].get("clean_tag", [])
+    entry = {
+        "scene_id": scene_information['scene_id'],
+        "oshash": scene_information['oshash'],
+        "old_path": scene_information['current_path'],
+        "new_path": scene_information['final_path'],
+        "associated": [[p, p_new] for p, p_new in associated_files(scene_information)],
+        "conflicts": conflicts,
+        "template": {"filename": template["filename"], "path": template["path"]["destination"] if template.get("path") else None},
+        "clean_tag": clean_tag,
+        "dry_run": plan["dry_run"]
+    }
+    plan_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def plan_from_entry(entry: dict):
+    scene_information = {
+        "scene_id": entry["scene_id"],
+        "oshash": entry["oshash"],
+        "current_path": entry["old_path"],
+        "current_directory": os.path.dirname(entry["old_path"]),
+        "current_filename": os.path.basename(entry["old_path"]),
+        "final_path": entry["new_path"],
+        "new_directory": os.path.dirname(entry["new_path"]),
+        "new_filename": os.path.basename(entry["new_path"]),
+        "associated": entry["associated"]
+    }
+    # clean_tag is done at the end, for all the scenes at once
+    return {"scene_information": scene_information, "template": {"filename": None, "path": None}, "dry_run": False, "path_too_long": False}
+
+
+def apply_plan_file(plan_path: str):
+    # Execute the plan written by the 'plan' task. The paths come from the file,
+    # no GraphQL request and no template per scene.
+    global VACATED_FOLDERS
+    if not os.path.exists(plan_path):
+        exit_plugin(err=f"Can't find the plan ({plan_path}). Run the 'Plan' task before.")
+    with open(plan_path, 'r', encoding='utf-8') as f:
+        entry_count = sum(1 for _ in f)
+    log.LogDebug(f"Count entries: {entry_count}")
+    stash_db = connect_db(STASH_DATABASE)
+    if stash_db is None:
+        exit_plugin()
+    path_index = build_path_index(stash_db)
+    db_writer = BatchWriter(stash_db, config.db_batch_size, config.db_batch_interval)
+    mover = MoveScheduler(config.move_workers, path_index, db_writer)
+    VACATED_FOLDERS = set()
+    clean_tags = {}
+    progress = 0
+    with open(plan_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            progress += 1
+            log.LogProgress(progress / entry_count)
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry["conflicts"]:
+                log.LogWarning(f"[{entry['scene_id']}] Skipped ({', '.join(entry['conflicts'])})")
+                continue
+            if entry["dry_run"]:
+                log.LogInfo(f"[{entry['scene_id']}] Skipped (dry_run option)")
+                continue
+            if int(entry["scene_id"]) not in path_index["path"].get(entry["old_path"], ()):
+                log.LogWarning(f"[{entry['scene_id']}] Skipped, the path has changed since the plan ({entry['old_path']})")
+                continue
+            MOVE_PROGRESS[:] = [(progress - 1) / entry_count, 1 / entry_count]
+            try:
+                if apply_rename(plan_from_entry(entry), stash_db, path_index, db_writer, mover) and entry["clean_tag"]:
+                    clean_tags.setdefault(tuple(entry["clean_tag"]), []).append(entry["scene_id"])
+            except Exception as err:
+                log.LogError(f"main function error: {err}")
+    mover.close()
+    db_writer.commit()
+    stash_db.close()
+    log.LogInfo("[SQLITE] Database closed!")
+    prune_vacated_folders()
+    for tag_ids, scene_ids in clean_tags.items():
+        scene_ids = [scene_id for scene_id in scene_ids if scene_id not in mover.failed]
+        if scene_ids:
+            graphql_removeScenesTag(scene_ids, list(tag_ids))
+
+
+def init_plan_worker():
+    PLAN_WORKER.active = True
+    PLAN_WORKER.timer = PhaseTimer()
+
+
+def plan_worker(scene: dict):
+    # Errors are given back to the applier instead of stopping the worker.
+    # In a worker, its timings are sent with the plan.
+    log.LogDebug(f"** Checking scene: {scene['title']} - {scene['id']} **")
+    try:
+        result = plan_rename(scene), None
+    except Exception as err:
+        result = None, str(err)
+    if getattr(PLAN_WORKER, "active", False):
+        return result + (PLAN_WORKER.timer.take(),)
+    return result
+
+
+def plan_result(result: tuple):
+    if len(result) == 3:
+        TIMER.merge(result[2])
+    return result[:2]
+
+
+def create_plan_pool(workers: int):
+    if workers == 1:
+        return None
+    if workers < 1:
+        workers = os.cpu_count() or 1
+    log.LogDebug(f"Computing the plans with {workers} workers")
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork").Pool(workers, initializer=init_plan_worker)
+    # No fork (Windows), threads still overlap the GraphQL lookups
+    return multiprocessing.pool.ThreadPool(workers, initializer=init_plan_worker)
+
+
+def planned_scenes(scenes, pool=None):
+    # Yield (scene, total, (plan, error)) in the same order as the scenes.
+    # The plans are computed ahead by the pool, the caller applies them one by one.
+    if pool is None:
+        for scene, total in scenes:
+            yield scene, total, plan_worker(scene)
+        return
+    pending = collections.deque()
+    # limit the plans waiting, so the scenes are still read page by page
+    max_pending = pool._processes * 8
+    for scene, total in scenes:
+        pending.append((scene, total, pool.apply_async(plan_worker, (scene,))))
+        if len(pending) >= max_pending:
+            scene, total, result = pending.popleft()
+            yield scene, total, plan_result(result.get())
+    while pending:
+        scene, total, result = pending.popleft()
+        yield scene, total, plan_result(result.get())
+
+
+def daemon_request(fragment: dict):
+    # A hook sent to the resident worker (renamer_daemon), same as running the plugin
+    global START_TIME, TIMER, DAEMON_DB
+    START_TIME = time.time()
+    TIMER = PhaseTimer()
+    FRAGMENT_SERVER.update(fragment["server_connection"])
+    if DRY_RUN:
+        if DRY_RUN_FILE and os.path.exists(DRY_RUN_FILE):
+            os.remove(DRY_RUN_FILE)
+        log.LogInfo("Dry mode on")
+    log.LogDebug("--Starting Hook 'Renamer'-- (worker)")
+    DIR_ENTRIES.clear()
+    if not hook_has_changes(fragment["args"]["hookContext"]):
+        exit_plugin("No change used by the templates, nothing to do")
+    # the studios may have been edited since the last hook
+    if STUDIO_TREE is not None:
+        tree = STUDIO_TREE
+        if load_studio_tree(check=True) is not tree:
+            studio_ancestors.cache_clear()
+            studio_template_filename.cache_clear()
+    if DAEMON_DB is None:
+        DAEMON_DB = connect_db(STASH_DATABASE)
+        if DAEMON_DB is None:
+            exit_plugin(err="Can't open the database")
+    journal_recover(own=True)
+    renamer(fragment["args"]["hookContext"]["id"], DAEMON_DB)
+    exit_plugin("Successful!")
 
 
 def exit_plugin(msg=None, err=None):
     if msg is None and err is None:
         msg = "plugin ended"
+    if getattr(PLAN_WORKER, "active", False):
+        # let the main process decide what to do
+        raise Exception(err or msg)
+    # only the tasks show it by default, a hook is one scene
+    TIMER.report(TIMER.counters.get("scenes"), config.timing_report_file, log.LogInfo if PLUGIN_ARGS not in (None, "daemon") else log.LogDebug)
     log.LogDebug("Execution time: {}s".format(round(time.time() - START_TIME, 5)))
     output_json = {"output": msg, "error": err}
     print(json.dumps(output_json))
@@ -1010,7 +2609,7 @@ def exit_plugin(msg=None, err=None):
 
 if PLUGIN_ARGS:
     log.LogDebug("--Starting Plugin 'Renamer'--")
-    if "bulk" not in PLUGIN_ARGS:
+    if "bulk" not in PLUGIN_ARGS and "plan" not in PLUGIN_ARGS and "daemon" not in PLUGIN_ARGS and "undo" not in PLUGIN_ARGS:
         if "enable" in PLUGIN_ARGS:
             log.LogInfo("Enable hook")
             success = config_edit("enable_hook", True)
@@ -1040,13 +2639,101 @@ LOGFILE = config.log_file
 #if FRAGMENT_HOOK_TYPE == "Scene.Update.Post":
 
 
-STASH_CONFIG = graphql_getConfiguration()
-STASH_DATABASE = STASH_CONFIG['general']['databasePath']
-TEMPLATE_FIELD = "$date $year $performer_path $performer $title $height $resolution $bitrate $parent_studio $studio_family $studio $rating $tags $video_codec $audio_codec $movie_title $movie_year $movie_scene $oshash $checksum".split(" ")
+TEMPLATE_FIELD = tuple("$date $year $performer_path $performer $title $height $resolution $bitrate $parent_studio $studio_family $studio $rating $tags $video_codec $audio_codec $movie_title $movie_year $movie_scene $oshash $checksum".split(" "))
+# fields of the scene update that change each template field, single and bulk edit names (movies/movie_ids, groups/group_ids for newer Stash).
+# $height, $oshash... only change with a scan
+HOOK_INPUT_FIELDS = {
+    "date": ("date",),
+    "year": ("date",),
+    "title": ("title",),
+    "performer": ("performer_ids",),
+    "performer_path": ("performer_ids",),
+    "studio": ("studio_id",),
+    "parent_studio": ("studio_id",),
+    "studio_family": ("studio_id",),
+    "studio_hierarchy": ("studio_id",),
+    "rating": ("rating", "rating100"),
+    "tags": ("tag_ids",),
+    "movie_title": ("movies", "movie_ids", "groups", "group_ids"),
+    "movie_year": ("movies", "movie_ids", "groups", "group_ids"),
+    "movie_scene": ("movies", "movie_ids", "groups", "group_ids")
+}
+# the file of the scene
+HOOK_INPUT_ALWAYS = ("primary_file_id",)
+# objects of the scene needed by each template field
+SCENE_FIELD_SELECTIONS = {
+    "performer": ("performers",),
+    "performer_path": ("performers",),
+    "studio": ("studio",),
+    "parent_studio": ("studio",),
+    "studio_family": ("studio",),
+    "studio_hierarchy": ("studio",),
+    "tags": ("tags",),
+    "movie_title": ("movies",),
+    "movie_year": ("movies",),
+    "movie_scene": ("movies",),
+    "height": ("file",),
+    "resolution": ("file",),
+    "bitrate": ("file",),
+    "video_codec": ("file",),
+    "audio_codec": ("file",)
+}
+# field -> function extracting it from the Stash scene (with the fields computed at the same time)
+SCENE_FIELD_EXTRACTORS = {
+    "title": extract_title,
+    "year": extract_year,
+    "rating": extract_rating,
+    "performer": extract_performers,
+    "performer_path": extract_performers,
+    "studio": extract_studio,
+    "parent_studio": extract_studio,
+    "studio_family": extract_studio,
+    "studio_hierarchy": extract_studio_hierarchy,
+    "tags": extract_tags,
+    "height": extract_file,
+    "resolution": extract_file,
+    "bitrate": extract_file,
+    "video_codec": extract_file,
+    "audio_codec": extract_file,
+    "movie_title": extract_movie,
+    "movie_year": extract_movie,
+    "movie_index": extract_movie
+}
+SCENE_SELECTIONS = {
+    "file": "file { video_codec audio_codec width height bitrate }",
+    "studio": "studio { id name parent_studio { id name } }",
+    "tags": "tags { id name }",
+    "movies": "movies { movie { name date } scene_index }"
+}
+
+CLEANUP_SEPARATOR_RE = re.compile(r'[\s_-]+(?=[^a-zA-Z0-9_#]{2})')
+CLEANUP_SPACE_RE = re.compile(r'\s+')
+CLEANUP_OPEN_RE = re.compile(r'([\[(])[_\s-]+')
+CLEANUP_CLOSE_RE = re.compile(r'[_\s-]+([\])])')
+CLEANUP_EMPTY_RE = re.compile(r'\(\W*\)|\[\W*\]')
+CLEANUP_BRACES_RE = re.compile(r'[{}]')
 
 # READING CONFIG
 
 ASSOCIATED_EXT = config.associated_extension
+# what follows the name of the video in the name of an associated file
+# no associated_extension: no associated file at all, the patterns included
+ASSOCIATED_PATTERNS = ["." + ext for ext in ASSOCIATED_EXT] + config.associated_patterns if ASSOCIATED_EXT else []
+ASSOCIATED_RE = None
+if ASSOCIATED_PATTERNS:
+    ASSOCIATED_RE = re.compile("|".join(fnmatch.translate(p) for p in ASSOCIATED_PATTERNS), re.IGNORECASE if os.name == "nt" else 0)
+# Stash's default, if the configuration doesn't have them
+VIDEO_EXTENSIONS_DEFAULT = ["m4v", "mp4", "mov", "wmv", "avi", "mpg", "mpeg", "rmvb", "rm", "flv", "asf", "mkv", "webm"]
+# listed folders (associated files), the most recent ones
+DIR_ENTRIES = collections.OrderedDict()
+DIR_ENTRIES_LOCK = threading.Lock()
+# folders left by the moves of a task, removed at the end if empty (remove_emptyfolder)
+VACATED_FOLDERS = None
+DIR_ENTRIES_MAX = 256
+# results of the path cleanup (cached_transform), the most recent ones
+TRANSFORM_CACHE = collections.OrderedDict()
+TRANSFORM_CACHE_LOCK = threading.Lock()
+TRANSFORM_CACHE_MAX = 4096
 
 FIELD_WHITESPACE_SEP = config.field_whitespaceSeperator
 FIELD_REPLACER = config.field_replacer
@@ -1056,6 +2743,7 @@ FILENAME_TITLECASE = config.titlecase_Filename
 FILENAME_SPLITCHAR = config.filename_splitchar
 FILENAME_REMOVECHARACTER = config.removecharac_Filename
 FILENAME_REPLACEWORDS = config.replace_words
+REPLACE_WORDS = compile_replace_words(FILENAME_REPLACEWORDS)
 
 PERFORMER_SPLITCHAR = config.performer_splitchar
 PERFORMER_LIMIT = config.performer_limit
@@ -1071,6 +2759,11 @@ SQUEEZE_STUDIO_NAMES = config.squeeze_studio_names
 
 RATING_FORMAT = config.rating_format
 
+# template rules compiled once: tag name -> rule, trie of the paths
+TAG_TEMPLATES = compile_tag_rules(config.tag_templates)
+P_TAG_TEMPLATES = compile_tag_rules(config.p_tag_templates)
+P_PATH_TEMPLATES = compile_path_rules(config.p_path_templates)
+
 TAGS_SPLITCHAR = config.tags_splitchar
 TAGS_WHITELIST = config.tags_whitelist
 TAGS_BLACKLIST = config.tags_blacklist
@@ -1080,8 +2773,22 @@ IGNORE_PATH_LENGTH = config.ignore_path_length
 PREVENT_CONSECUTIVE = config.prevent_consecutive
 REMOVE_EMPTY_FOLDER = config.remove_emptyfolder
 
+COPY_CHUNK_SIZE = config.copy_chunk_size * 1024 * 1024
+# last bytes compared before resuming a partial copy
+COPY_RESUME_CHECK = 1024 * 1024
+# fastest first, the plain read/write always works
+COPY_METHODS = [m for m in ("copy_file_range", "sendfile") if hasattr(os, m)] + ["readwrite"]
+COPY_FALLBACK_ERRNO = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF, getattr(errno, "ENOTSUP", errno.EOPNOTSUPP), getattr(errno, "ENOTSOCK", errno.EINVAL)}
+# (start, width) of the current scene in the task progress bar, for the copy progress
+MOVE_PROGRESS = [0.0, 1.0]
+# kept free on a drive by the move scheduler (associated files, .part of a resumed copy)
+MOVE_FREE_MARGIN = 64 * 1024 * 1024
+
 PROCESS_KILL = config.process_kill_attach
 PROCESS_ALLRESULT = config.process_getall
+# open files of the processes, see has_handle
+PROC_HANDLES = None
+PROC_FD = os.path.isdir("/proc/self/fd")
 UNICODE_USE = config.use_ascii
 
 ORDER_SHORTFIELD = config.order_field
@@ -1092,25 +2799,144 @@ PATH_KEEP_ALRPERF = config.path_keep_alrperf
 PATH_NON_ORGANIZED = config.p_non_organized
 PATH_ONEPERFORMER = config.path_one_performer
 
+PLAN_FILE = os.path.join(PLUGIN_DIR, "renamerOnUpdate_plan.jsonl")
+
+STUDIO_TREE = None
+STUDIO_TREE_KEY = None
+STUDIO_CACHE_FILE = os.path.join(PLUGIN_DIR, "studio_cache.json")
+
+# database connection kept by the hook worker
+DAEMON_DB = None
+
+BATCH_PER_PAGE = config.batch_per_page
+BATCH_SORT = config.batch_sort
+BATCH_WORKERS = config.batch_workers
+# locked database: each try waits DB_BUSY_TRY_MS, then the next one is in DB_BUSY_DELAY..DB_BUSY_DELAY_MAX seconds
+DB_BUSY_TRY_MS = 200
+DB_BUSY_DELAY = 0.25
+DB_BUSY_DELAY_MAX = 2
+# above, the path templates aren't sent to Stash as a filter (one level of OR each)
+PREFILTER_MAX_PATHS = 50
+
+# write-ahead journal of the moves (rename_journal option)
+JOURNAL_FILE = os.path.join(PLUGIN_DIR, "renamerOnUpdate_journal.db")
+JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, task TEXT, pid INTEGER, started REAL);
+CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, run_id INTEGER, scene_id INTEGER, kind TEXT, old_path TEXT, new_path TEXT, state TEXT, undo_of INTEGER, updated REAL);
+CREATE INDEX IF NOT EXISTS entries_state ON entries (state);
+CREATE INDEX IF NOT EXISTS entries_run ON entries (run_id, state);
+"""
+JOURNAL_KEEP_DAYS = 30
+JOURNAL = None
+JOURNAL_LOCK = threading.RLock()
+JOURNAL_RUN = None
+
+# watermark (updated_at) and config hash of the last bulk run, for the incremental task
+BULK_STATE_FILE = os.path.join(PLUGIN_DIR, "renamerOnUpdate_bulk.json")
+# options that don't change the new paths, editing them doesn't force a full run
+INCREMENTAL_IGNORED_CONFIG = {
+    "enable_hook", "dry_run", "hook_daemon", "hook_daemon_idle", "log_file", "alt_diff_display",
+    "batch_number_scene", "batch_per_page", "batch_sort", "batch_workers", "db_batch_size", "db_batch_interval", "batch_prefilter",
+    "copy_chunk_size", "move_workers", "process_getall", "process_kill_attach", "rename_journal", "timing_report_file", "db_busy_timeout", "db_busy_timeout_hook"
+}
+
+# before asking anything to Stash
+if not PLUGIN_ARGS and not hook_has_changes(FRAGMENT["args"]["hookContext"]):
+    exit_plugin("No change used by the templates, nothing to do")
+
+STASH_CONFIG = graphql_getConfiguration()
+STASH_DATABASE = STASH_CONFIG['general']['databasePath']
+STASH_ROOTS = [os.path.normcase(os.path.normpath(stash['path'])) for stash in STASH_CONFIG['general'].get('stashes') or []]
+VIDEO_EXTENSIONS = {ext.lower() for ext in STASH_CONFIG['general'].get('videoExtensions') or VIDEO_EXTENSIONS_DEFAULT}
+
+# moves of a previous run that was killed
+if PLUGIN_ARGS != "plan":
+    journal_recover()
+
 if PLUGIN_ARGS:
-    if "bulk" in PLUGIN_ARGS:
-        scenes = graphql_findScene(config.batch_number_scene, "ASC")
-        log.LogDebug(f"Count scenes: {len(scenes['scenes'])}")
-        progress = 0
-        progress_step = 1 / len(scenes['scenes'])
+    if "daemon" in PLUGIN_ARGS:
+        # Resident worker for the hook, started by the hook itself (hook_daemon option)
+        watch = [__file__, config.__file__, renamer_daemon.__file__, log.__file__, os.path.join(PLUGIN_DIR, "template_compiler.py"), os.path.join(PLUGIN_DIR, "phase_timer.py")]
+        renamer_daemon.serve(PLUGIN_DIR, daemon_request, config.hook_daemon_idle, watch, DAEMON_LOCK)
+        # before a new worker can start
+        journal_recover(own=True)
+        if DAEMON_DB is not None:
+            DAEMON_DB.close()
+        DAEMON_LOCK.close()
+        sys.exit()
+    if "undo" in PLUGIN_ARGS:
+        journal_undo()
+    elif "apply_plan" in PLUGIN_ARGS:
+        apply_plan_file(PLAN_FILE)
+    elif "bulk" in PLUGIN_ARGS or "plan" in PLUGIN_ARGS:
+        plan_file = None
+        if "plan" in PLUGIN_ARGS:
+            plan_file = open(PLAN_FILE, 'w', encoding='utf-8')
+        # Loaded before starting the workers, so they all use it.
+        load_studio_tree()
+        # Created before opening the database, the workers never use it.
+        plan_pool = create_plan_pool(BATCH_WORKERS)
         stash_db = connect_db(STASH_DATABASE)
         if stash_db is None:
             exit_plugin()
-        for scene in scenes['scenes']:
-            log.LogDebug(f"** Checking scene: {scene['title']} - {scene['id']} **")
+        path_index = build_path_index(stash_db)
+        db_writer = BatchWriter(stash_db, config.db_batch_size, config.db_batch_interval)
+        mover = MoveScheduler(config.move_workers, path_index, db_writer)
+        VACATED_FOLDERS = set()
+        # the next incremental run starts from the state of Stash before this one
+        save_state = not plan_file and not DRY_RUN
+        run_state = {"retry": []}
+        if save_state or "incremental" in PLUGIN_ARGS:
+            run_state.update(config_hash=config_hash(), updated_at=latest_updated_at())
+        scenes = None
+        scene_filter = bulk_scene_filter() if config.batch_prefilter else None
+        if scene_filter:
+            log.LogDebug(f"Only the scenes matching {json.dumps(scene_filter)}")
+        if "incremental" in PLUGIN_ARGS:
+            last_state = load_bulk_state()
+            if last_state.get("updated_at") and last_state.get("config_hash") == run_state["config_hash"]:
+                log.LogInfo(f"Checking the scenes updated since {last_state['updated_at']}")
+                scenes = incremental_source(last_state, BATCH_PER_PAGE, BATCH_SORT, scene_filter)
+            else:
+                log.LogInfo("First run, or the config/templates have changed: checking all the scenes")
+        if scenes is None:
+            # only a run over all the scenes can be continued incrementally
+            save_state = save_state and config.batch_number_scene == -1
+            scenes = scene_source(config.batch_number_scene, BATCH_PER_PAGE, BATCH_SORT, scene_filter)
+        progress = 0
+        for scene, scene_count, (plan, plan_err) in planned_scenes(scenes, plan_pool):
+            if progress == 0:
+                log.LogDebug(f"Count scenes: {scene_count}")
             try:
-                renamer(scene, stash_db)
+                if plan_err:
+                    raise Exception(plan_err)
+                if plan and plan_file:
+                    write_plan_entry(plan_file, plan, path_index)
+                elif plan:
+                    MOVE_PROGRESS[:] = [progress / scene_count, 1 / scene_count]
+                    if not apply_rename(plan, stash_db, path_index, db_writer, mover) and not plan["dry_run"] and not plan["path_too_long"]:
+                        run_state["retry"].append(scene["id"])
             except Exception as err:
                 log.LogError(f"main function error: {err}")
-            progress += progress_step
-            log.LogProgress(progress)
+                run_state["retry"].append(scene["id"])
+            progress += 1
+            log.LogProgress(progress / scene_count)
+        if plan_pool:
+            plan_pool.close()
+            plan_pool.join()
+        mover.close()
+        run_state["retry"].extend(mover.failed)
+        db_writer.commit()
         stash_db.close()
         log.LogInfo("[SQLITE] Database closed!")
+        prune_vacated_folders()
+        if save_state:
+            save_bulk_state(run_state)
+            if run_state["retry"]:
+                log.LogInfo(f"{len(run_state['retry'])} scene(s) failed, they will be checked again by the next incremental run")
+        if plan_file:
+            plan_file.close()
+            log.LogInfo(f"Plan saved in {PLAN_FILE}, use the 'Apply plan' task to execute it.")
 else:
     renamer(FRAGMENT_SCENE_ID)
 
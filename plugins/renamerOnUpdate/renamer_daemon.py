@@ -0,0 +1,191 @@
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import log
+
+# Resident worker for the Scene.Update.Post hook (hook_daemon option).
+#
+# Without it, every hook starts a new Python, imports the modules, asks Stash for
+# its configuration and opens the database. With it, the first hook starts a
+# worker that keeps all of that loaded, the next hooks only send their fragment
+# over a Unix socket and print what the worker answers (logs and output).
+# If the worker can't be reached, the hook does the rename itself.
+#
+# Only the standard library (and log.py) is used here, the hook imports this module first.
+
+SOCKET_NAME = "renamerOnUpdate.sock"
+LOCK_NAME = "renamerOnUpdate.sock.lock"
+# waiting for the worker to accept the connection
+CONNECT_TIMEOUT = 2
+# waiting for the answer, a rename can copy a file to another drive
+REPLY_TIMEOUT = 3600
+# tries (every 0.1s) to get the worker lock
+LOCK_RETRY = 20
+
+
+def supported():
+    # No Unix socket on Windows
+    return hasattr(socket, "AF_UNIX")
+
+
+def socket_path(plugin_dir: str):
+    return os.path.join(plugin_dir, SOCKET_NAME)
+
+
+def read_line(conn: socket.socket):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def send_request(path: str, fragment: dict):
+    # Answer of the worker, None if it isn't running
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(CONNECT_TIMEOUT)
+            conn.connect(path)
+            conn.settimeout(REPLY_TIMEOUT)
+            conn.sendall(json.dumps(fragment).encode() + b"\n")
+            reply = read_line(conn)
+    except OSError:
+        return None
+    if not reply:
+        return None
+    return json.loads(reply)
+
+
+def start_worker(fragment: dict, script: str):
+    # The worker is the plugin itself in 'daemon' mode, in its own session so it
+    # isn't stopped with the hook.
+    worker_fragment = {"server_connection": fragment["server_connection"], "args": {"mode": "daemon"}}
+    try:
+        proc = subprocess.Popen([sys.executable, os.path.abspath(script)], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(script)), start_new_session=True)
+        proc.stdin.write(json.dumps(worker_fragment).encode())
+        proc.stdin.close()
+    except OSError:
+        pass
+
+
+def forward_hook(fragment: dict, script: str):
+    # Exits if the worker did the job, else returns so the hook runs in this process.
+    if not supported():
+        return
+    plugin_dir = fragment["server_connection"]["PluginDir"]
+    reply = send_request(socket_path(plugin_dir), fragment)
+    if reply is None and worker_locked(plugin_dir):
+        # a worker is starting (not listening yet), no need for another one
+        return
+    if reply is None or reply.get("stale"):
+        start_worker(fragment, script)
+        return
+    sys.stderr.write(reply["stderr"])
+    sys.stderr.flush()
+    sys.stdout.write(reply["stdout"])
+    sys.stdout.flush()
+    sys.exit()
+
+
+def worker_locked(plugin_dir: str):
+    # True if a worker has the lock: running, starting or stopping
+    import fcntl
+    try:
+        with open(os.path.join(plugin_dir, LOCK_NAME), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return True
+    return False
+
+
+def lock_worker(plugin_dir: str):
+    # Only one worker per plugin folder, the lock is kept while it runs. Taken by the
+    # worker before loading the plugin, so a second one exits before any work.
+    # Waits a bit for a worker that is stopping (config changed).
+    import fcntl
+    lock = open(os.path.join(plugin_dir, LOCK_NAME), 'w')
+    for _ in range(LOCK_RETRY):
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock
+        except OSError:
+            time.sleep(0.1)
+    lock.close()
+    return None
+
+
+def files_mtime(files: list):
+    mtimes = []
+    for f in files:
+        try:
+            mtimes.append(os.stat(f).st_mtime)
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+
+def run_request(handler, fragment: dict):
+    # The logs (stderr) and the output (stdout) of the handler are sent to the hook
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = io.StringIO(), io.StringIO()
+    try:
+        handler(fragment)
+    except SystemExit:
+        pass
+    except Exception as err:
+        log.LogError(f"Worker error: {err}")
+        print(json.dumps({"output": None, "error": f"Worker error: {err}"}))
+    finally:
+        reply = {"stdout": sys.stdout.getvalue(), "stderr": sys.stderr.getvalue()}
+        sys.stdout, sys.stderr = stdout, stderr
+    return reply
+
+
+def serve(plugin_dir: str, handler, idle_timeout: float, watch: list, lock):
+    # handler(fragment) does the hook, ending with exit_plugin like the plugin itself.
+    # Stops after idle_timeout seconds without hook, or when a file of watch changes
+    # (config edited, plugin updated): the hook then runs in its own process and
+    # starts a new worker. lock: from lock_worker, kept until the caller closes it.
+    path = socket_path(plugin_dir)
+    start_mtime = files_mtime(watch)
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(path)
+        server.listen(64)
+        server.settimeout(idle_timeout)
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                break
+            with conn:
+                conn.settimeout(CONNECT_TIMEOUT)
+                try:
+                    fragment = json.loads(read_line(conn))
+                except (OSError, ValueError):
+                    continue
+                stale = files_mtime(watch) != start_mtime
+                if stale:
+                    reply = {"stale": True}
+                else:
+                    reply = run_request(handler, fragment)
+                try:
+                    conn.sendall(json.dumps(reply).encode() + b"\n")
+                except OSError:
+                    pass
+            if stale:
+                break
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.remove(path)
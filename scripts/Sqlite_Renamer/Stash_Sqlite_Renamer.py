@@ -5,6 +5,8 @@ import sys
 
 import progressbar
 
+from template_compiler import compile_template
+
 # Your sqlite path
 DB_PATH = r"C:\Users\Winter\.stash\Full.sqlite"
 # Log keep a trace of OldPath & new_path. Could be useful if you want to revert everything. Filename: rename_log.txt
@@ -16,6 +18,14 @@ FEMALE_ONLY = False
 # Print debug message
 DEBUG_MODE = True
 
+TEMPLATE_FIELD = ("$date", "$performer", "$title", "$studio", "$height")
+
+START_DASH_RE = re.compile(r'^\s*-\s*')
+END_DASH_RE = re.compile(r'\s*-\s*$')
+EMPTY_BRACKET_RE = re.compile(r'\[\W*]')
+MULTI_SPACE_RE = re.compile(r'\s{2,}')
+
+
 def logPrint(q):
     if "[DEBUG]" in q and DEBUG_MODE == False:
         return
@@ -93,40 +103,12 @@ def makeFilename(scene_info, query):
     # $title                              == SSNI-000.mp4
     # $date $title                        == 2017-04-27 Oni Chichi.mp4
     # $date $performer - $title [$studio] == 2016-12-29 Eva Lovia - Her Fantasy Ball [Sneaky Sex].mp4
-    new_filename = str(query)
-    if "$date" in new_filename:
-        if scene_info.get('date') == "" or scene_info.get('date') is None:
-            new_filename = re.sub('\$date\s*', '', new_filename)
-        else:
-            new_filename = new_filename.replace("$date", scene_info["date"])
-
-    if "$performer" in new_filename:
-        if scene_info.get('performer') == "" or scene_info.get('performer') is None:
-            new_filename = re.sub('\$performer\s*', '', new_filename)
-        else:
-            new_filename = new_filename.replace("$performer", scene_info["performer"])
-
-    if "$title" in new_filename:
-        if scene_info.get('title') == "" or scene_info.get('title') is None:
-            new_filename = re.sub('\$title\s*', '', new_filename)
-        else:
-            new_filename = new_filename.replace("$title", scene_info["title"])
-
-    if "$studio" in new_filename:
-        if scene_info.get('studio') == "" or scene_info.get('studio') is None:
-            new_filename = re.sub('\$studio\s*', '', new_filename)
-        else:
-            new_filename = new_filename.replace("$studio", scene_info["studio"])
-
-    if "$height" in new_filename:
-        if scene_info.get('height') == "" or scene_info.get('height') is None:
-            new_filename = re.sub('\$height\s*', '', new_filename)
-        else:
-            new_filename = new_filename.replace("$height", scene_info["height"])
-    new_filename = re.sub('^\s*-\s*', '', new_filename)
-    new_filename = re.sub('\s*-\s*$', '', new_filename)
-    new_filename = re.sub('\[\W*]', '', new_filename)
-    new_filename = re.sub('\s{2,}', ' ', new_filename)
+    template = compile_template(query, TEMPLATE_FIELD, groups=False, strip_after=r"\s*")
+    new_filename = template.render(scene_info.get)
+    new_filename = START_DASH_RE.sub('', new_filename)
+    new_filename = END_DASH_RE.sub('', new_filename)
+    new_filename = EMPTY_BRACKET_RE.sub('', new_filename)
+    new_filename = MULTI_SPACE_RE.sub(' ', new_filename)
     new_filename = new_filename.strip()
     return new_filename
 
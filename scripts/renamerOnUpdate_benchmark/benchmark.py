@@ -0,0 +1,358 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Benchmark of the renamerOnUpdate plugin, without Stash and without real media.
+#
+# For each size, a synthetic library is generated (performers, studios with parent
+# chains, tags, movies, long unicode titles) in a temporary folder: sparse video
+# files, a SQLite database with the 'scenes' table used by the plugin and a small
+# GraphQL server answering the queries of the plugin. The plugin (a copy of the
+# given folder) is then run like Stash does: some hooks, then the bulk task.
+#
+# python benchmark.py --scenes 1000 10000 --plugin ../../plugins/renamerOnUpdate --plugin old/renamerOnUpdate
+
+DEFAULT_PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "plugins", "renamerOnUpdate")
+
+# appended to the config.py of the plugin, {library} is the destination folder
+DEFAULT_CONFIG = """
+use_default_template = True
+default_template = "$date $performer - $title [$studio] $resolution $video_codec"
+tag_templates = {{"Tag 1": "$year $title - $tags", "Tag 2": "{{$movie_title - $movie_scene}} $title"}}
+p_use_default_template = True
+p_default_template = r"{library}/$studio_hierarchy"
+p_tag_templates = {{"Tag 3": r"{library}/$performer"}}
+"""
+
+TITLE_WORDS = ["Summer", "Night", "Dream", "Café", "Élan", "Über", "Straße", "Ñandú", "Fjörd", "Crème", "Brûlée", "夜", "東京", "物語",
+               "Rendez-vous", "naïve", "Déjà", "Vu", "Smørrebrød", "Zoë's", "Łódź", "Ærø", "the", "of", "and", "[Part 2]", "(Remastered)"]
+FIRST_NAMES = ["Anna", "Zoë", "Renée", "Chloé", "Ayaka", "Ваня", "Lucía", "Maëlle", "Søren", "Mia", "Nora", "Ines", "Yuki", "Olga"]
+LAST_NAMES = ["Müller", "Dupont", "García", "Novák", "Sørensen", "Ito", "Petrova", "O'Brien", "Nakamura", "Lefèvre", "Kowalski"]
+CODECS = [("h264", "aac"), ("hevc", "aac"), ("vp9", "opus"), ("av1", "opus"), ("mpeg4", "mp3")]
+HEIGHTS = [(640, 480), (1280, 720), (1920, 1080), (3840, 2160), (7680, 4320), (1080, 1920)]
+
+
+class Library:
+    # Synthetic scenes, in the format of the GraphQL answers of Stash
+    def __init__(self, root: str, count: int, seed: int):
+        rnd = random.Random(seed)
+        self.root = root
+        self.media = os.path.join(root, "media")
+        self.database = os.path.join(root, "stash.sqlite")
+        self.performers = [{"id": str(i), "name": f"{rnd.choice(FIRST_NAMES)} {rnd.choice(LAST_NAMES)}", "gender": rnd.choice(["FEMALE", "MALE", "FEMALE", "TRANSGENDER_FEMALE"]),
+                            "favorite": rnd.random() < 0.2, "rating": rnd.choice([None, 1, 2, 3, 4, 5])} for i in range(1, max(50, count // 20) + 1)]
+        self.studios = {}
+        # networks with sub-studios, up to 4 levels
+        for i in range(1, max(10, count // 100) + 1):
+            parent = None
+            if i > 5 and rnd.random() < 0.7:
+                parent = self.studios[str(rnd.randint(1, i - 1))]
+            self.studios[str(i)] = {"id": str(i), "name": f"Studio {i} {rnd.choice(TITLE_WORDS)}", "updated_at": "2020-01-01T00:00:00Z",
+                                    "parent_studio": {"id": parent["id"], "name": parent["name"]} if parent else None}
+        self.tags = [{"id": str(i), "name": f"Tag {i}"} for i in range(1, 201)]
+        self.movies = [{"name": " ".join(rnd.choice(TITLE_WORDS) for _ in range(3)), "date": f"{rnd.randint(1990, 2023)}-01-01"} for _ in range(max(10, count // 50))]
+        self.scenes = []
+        folders = [os.path.join(self.media, f"folder {i:03d}") for i in range(max(5, count // 200))]
+        for folder in folders:
+            os.makedirs(folder, exist_ok=True)
+        connection = sqlite3.connect(self.database)
+        connection.execute("CREATE TABLE scenes (id INTEGER PRIMARY KEY, path TEXT, updated_at TEXT)")
+        for i in range(1, count + 1):
+            width, height = rnd.choice(HEIGHTS)
+            video_codec, audio_codec = rnd.choice(CODECS)
+            studio = self.studios[rnd.choice(list(self.studios))] if rnd.random() < 0.9 else None
+            path = os.path.join(rnd.choice(folders), f"scene_{i}_{rnd.getrandbits(32):08x}.mp4")
+            size = rnd.randint(200, 8000) * 1024 * 1024
+            with open(path, 'wb') as f:
+                # sparse: no space used
+                f.truncate(size)
+            if rnd.random() < 0.1:
+                with open(path[:-4] + ".srt", 'w') as f:
+                    f.write("1\n")
+            scene = {
+                "id": str(i), "oshash": f"{rnd.getrandbits(64):016x}", "checksum": f"{rnd.getrandbits(128):032x}",
+                "title": " ".join(rnd.choice(TITLE_WORDS) for _ in range(rnd.randint(2, 12))) if rnd.random() < 0.95 else None,
+                "date": f"{rnd.randint(2000, 2023)}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}" if rnd.random() < 0.9 else None,
+                "rating": rnd.choice([None, 1, 2, 3, 4, 5]), "organized": rnd.random() < 0.6, "path": path,
+                "updated_at": f"2021-01-01T00:00:00.{i:06d}Z",
+                "file": {"video_codec": video_codec, "audio_codec": audio_codec, "width": width, "height": height, "bitrate": rnd.randint(1, 40) * 1000000, "size": size},
+                "studio": studio and {"id": studio["id"], "name": studio["name"], "parent_studio": studio["parent_studio"]},
+                "tags": rnd.sample(self.tags, rnd.randint(0, 8)),
+                "performers": rnd.sample(self.performers, rnd.choice([0, 1, 1, 1, 2, 2, 3, 4, 6])),
+                "movies": [{"movie": rnd.choice(self.movies), "scene_index": rnd.randint(1, 12)}] if rnd.random() < 0.2 else []
+            }
+            self.scenes.append(scene)
+            connection.execute("INSERT INTO scenes VALUES (?, ?, ?);", [i, path, scene["updated_at"]])
+        connection.commit()
+        connection.close()
+        self.by_id = {scene["id"]: scene for scene in self.scenes}
+        self.lists = {}
+
+
+class GraphQLHandler(BaseHTTPRequestHandler):
+    # Answers the queries of the plugin. The paths come from the database, like Stash
+    # after the plugin updated it.
+    library = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        query, variables = body["query"], body.get("variables") or {}
+        data = answer(self.library, query, variables)
+        out = json.dumps({"data": data}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+
+def answer(library: Library, query: str, variables: dict):
+    if "configuration" in query:
+        return {"configuration": {"general": {"databasePath": library.database, "stashes": [{"path": library.media}]}}}
+    if "findScenes" in query:
+        find_filter = variables.get("filter") or {}
+        scene_filter = variables.get("scene_filter") or {}
+        # next page of the plugin: id > last id, AND the filter of the task
+        after_id = None
+        if "id" in scene_filter:
+            after_id = int(scene_filter["id"]["value"])
+            scene_filter = scene_filter.get("AND") or {}
+        scenes = filtered_scenes(library, scene_filter, find_filter.get("sort", "updated_at"), find_filter.get("direction", "DESC"))
+        if after_id is not None:
+            scenes = [scene for scene in scenes if int(scene["id"]) > after_id]
+        count = len(scenes)
+        per_page, page = find_filter.get("per_page", 25), find_filter.get("page", 1)
+        if per_page != -1:
+            scenes = scenes[(page - 1) * per_page:page * per_page]
+        return {"findScenes": {"count": count, "scenes": project(library, scenes, query)}}
+    if "findTags" in query:
+        return {"findTags": {"count": len(library.tags), "tags": library.tags}}
+    if "findScene" in query:
+        scene = library.by_id.get(str(variables.get("id")))
+        return {"findScene": project(library, [scene], query)[0] if scene else None}
+    if "findStudios" in query:
+        return {"findStudios": {"count": len(library.studios), "studios": list(library.studios.values())}}
+    if "findStudio" in query:
+        return {"findStudio": library.studios.get(str(variables.get("id")))}
+    if "SceneUpdate" in query:
+        return {"bulkSceneUpdate": []}
+    return None
+
+
+def filtered_scenes(library: Library, scene_filter: dict, sort: str, direction: str):
+    key = (json.dumps(scene_filter, sort_keys=True), sort, direction)
+    if key in library.lists:
+        return library.lists[key]
+    paths = None
+    if '"path"' in key[0]:
+        # the renamed scenes leave a path filter: on the paths of the database, never cached
+        connection = sqlite3.connect(library.database)
+        paths = dict(connection.execute("SELECT id, path FROM scenes;"))
+        connection.close()
+    scenes = [scene for scene in library.scenes if matches_filter(library, scene, scene_filter, paths)]
+    sort_key = (lambda s: int(s["id"])) if sort == "id" else (lambda s: s.get(sort) or "")
+    scenes.sort(key=sort_key, reverse=direction == "DESC")
+    if paths is None:
+        library.lists[key] = scenes
+    return scenes
+
+
+def matches_filter(library: Library, scene: dict, scene_filter: dict, paths=None):
+    # The criteria of the level, combined with its AND/OR/NOT sub-filter like Stash
+    result = all(matches(library, scene, name, criterion, paths) for name, criterion in scene_filter.items() if name not in ("AND", "OR", "NOT"))
+    if scene_filter.get("AND"):
+        return result and matches_filter(library, scene, scene_filter["AND"], paths)
+    if scene_filter.get("OR"):
+        return result or matches_filter(library, scene, scene_filter["OR"], paths)
+    if scene_filter.get("NOT"):
+        return result and not matches_filter(library, scene, scene_filter["NOT"], paths)
+    return result
+
+
+def matches(library: Library, scene: dict, name: str, criterion, paths=None):
+    # The SceneFilterType criteria used by the plugin
+    if name == "organized":
+        return scene["organized"] == criterion
+    if name == "updated_at":
+        return scene["updated_at"] > criterion["value"]
+    if name == "id":
+        return int(scene["id"]) > int(criterion["value"])
+    if name == "tags":
+        return any(tag["id"] in criterion["value"] for tag in scene["tags"])
+    if name == "studios":
+        studio = scene["studio"] and library.studios[scene["studio"]["id"]]
+        while studio:
+            if studio["id"] in criterion["value"]:
+                return True
+            if criterion.get("depth") != -1 or not studio["parent_studio"]:
+                return False
+            studio = library.studios[studio["parent_studio"]["id"]]
+        return False
+    if name == "path":
+        # LIKE '%value%', on the current path (paths: id -> path of the database)
+        path = paths.get(int(scene["id"]), scene["path"]) if paths else scene["path"]
+        return criterion["value"].lower() in path.lower()
+    return True
+
+
+def project(library: Library, scenes: list, query: str):
+    # Only the objects asked by the query, with the current path of the database
+    connection = sqlite3.connect(library.database)
+    paths = dict(connection.execute(f"SELECT id, path FROM scenes WHERE id IN ({','.join('?' * len(scenes))});", [int(s["id"]) for s in scenes]))
+    connection.close()
+    result = []
+    for scene in scenes:
+        scene = {k: v for k, v in scene.items() if not isinstance(v, (dict, list)) or (k + " {") in query}
+        scene["path"] = paths.get(int(scene["id"]), scene["path"])
+        result.append(scene)
+    return result
+
+
+def serve(library: Library):
+    handler = type("Handler", (GraphQLHandler,), {"library": library})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def install_plugin(source: str, root: str, config_extra: str):
+    plugin_dir = os.path.join(root, "plugin")
+    shutil.rmtree(plugin_dir, ignore_errors=True)
+    shutil.copytree(source, plugin_dir, ignore=shutil.ignore_patterns("__pycache__", "*.db", "*.json", "*.jsonl", "*.sock*"))
+    with open(os.path.join(plugin_dir, "config.py"), 'a', encoding='utf-8') as f:
+        f.write("\n" + config_extra + "\n")
+    return plugin_dir
+
+
+def run_plugin(plugin_dir: str, port: int, args: dict):
+    fragment = {"server_connection": {"Scheme": "http", "Host": "127.0.0.1", "Port": port, "SessionCookie": {"Value": "benchmark"},
+                                      "PluginDir": plugin_dir, "Dir": os.path.dirname(plugin_dir)}, "args": args}
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, os.path.join(plugin_dir, "renamerOnUpdate.py")], input=json.dumps(fragment),
+                             capture_output=True, text=True, cwd=plugin_dir)
+    elapsed = time.perf_counter() - start
+    errors = [line for line in process.stderr.splitlines() if line[1:2] == "e" or "Traceback" in line]
+    return elapsed, process, errors
+
+
+def moved_scenes(library: Library):
+    connection = sqlite3.connect(library.database)
+    moved = sum(1 for scene_id, path in connection.execute("SELECT id, path FROM scenes;") if path != library.by_id[str(scene_id)]["path"])
+    connection.close()
+    return moved
+
+
+def read_timing(path: str):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def benchmark(plugin: str, count: int, args) -> list:
+    root = tempfile.mkdtemp(prefix=f"renamer_bench_{count}_", dir=args.tmp)
+    results = []
+    try:
+        start = time.perf_counter()
+        library = Library(root, count, args.seed)
+        print(f"  {count} scenes generated in {time.perf_counter() - start:.1f}s ({root})", flush=True)
+        server = serve(library)
+        port = server.server_address[1]
+        timing_file = os.path.join(root, "timing.json")
+        config_extra = DEFAULT_CONFIG.format(library=os.path.join(root, "library"))
+        config_extra += f'\nbatch_workers = {args.workers}\ntiming_report_file = r"{timing_file}"\n'
+        if args.hook_daemon:
+            config_extra += "\nhook_daemon = True\nhook_daemon_idle = 5\n"
+        if args.config:
+            with open(args.config, encoding='utf-8') as f:
+                config_extra += "\n" + f.read()
+        plugin_dir = install_plugin(plugin, root, config_extra)
+
+        # hooks: one process per scene update, like Stash
+        hook_ids = random.Random(args.seed).sample(range(1, count + 1), min(args.hooks, count))
+        if hook_ids:
+            elapsed, errors = 0.0, []
+            for scene_id in hook_ids:
+                context = {"type": "Scene.Update.Post", "id": scene_id, "inputFields": ["title", "performer_ids", "studio_id", "tag_ids"]}
+                hook_elapsed, _, hook_errors = run_plugin(plugin_dir, port, {"hookContext": context})
+                elapsed += hook_elapsed
+                errors += hook_errors
+            results.append({"plugin": plugin, "scenes": count, "mode": "hook", "runs": len(hook_ids), "seconds": elapsed,
+                            "scenes_per_second": len(hook_ids) / elapsed, "errors": len(errors), "moved": moved_scenes(library)})
+            print_errors(errors)
+
+        # bulk task over all the scenes
+        elapsed, process, errors = run_plugin(plugin_dir, port, {"mode": "bulk"})
+        result = {"plugin": plugin, "scenes": count, "mode": "bulk", "runs": 1, "seconds": elapsed, "scenes_per_second": count / elapsed,
+                  "errors": len(errors), "moved": moved_scenes(library)}
+        timing = read_timing(timing_file)
+        if timing:
+            result["phases"] = timing["phases"]
+        results.append(result)
+        print_errors(errors)
+        server.shutdown()
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def print_errors(errors: list):
+    for line in errors[:5]:
+        print(f"    ! {line}")
+    if len(errors) > 5:
+        print(f"    ! ... {len(errors) - 5} more")
+
+
+def print_table(results: list):
+    print()
+    print(f"{'plugin':<40} {'scenes':>7} {'mode':<5} {'runs':>5} {'seconds':>9} {'scenes/s':>9} {'moved':>7} {'errors':>6}  render p50/p95")
+    for r in results:
+        render = r.get("phases", {}).get("render")
+        render = f"{render['p50'] * 1000:.3f}/{render['p95'] * 1000:.3f}ms" if render else "-"
+        plugin = r["plugin"] if len(r["plugin"]) <= 40 else "..." + r["plugin"][-37:]
+        print(f"{plugin:<40} {r['scenes']:>7} {r['mode']:<5} {r['runs']:>5} {r['seconds']:>9.2f} {r['scenes_per_second']:>9.1f} {r['moved']:>7} {r['errors']:>6}  {render}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the renamerOnUpdate plugin on a synthetic library.")
+    parser.add_argument("--plugin", action="append", help="folder of the plugin to test (several to compare versions)")
+    parser.add_argument("--scenes", type=int, nargs="+", default=[1000, 10000, 100000], help="library sizes")
+    parser.add_argument("--hooks", type=int, default=100, help="scene updates (hooks) to time per size, 0 = none")
+    parser.add_argument("--workers", type=int, default=1, help="batch_workers of the bulk task")
+    parser.add_argument("--hook-daemon", action="store_true", help="run the hooks with the hook_daemon option")
+    parser.add_argument("--config", help="file with more config.py lines (templates, options)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tmp", help="folder for the libraries (default: system temp)")
+    parser.add_argument("--keep", action="store_true", help="don't delete the libraries")
+    parser.add_argument("--json", help="save the results in this file")
+    args = parser.parse_args()
+    plugins = [os.path.abspath(p) for p in args.plugin or [DEFAULT_PLUGIN]]
+    if args.tmp:
+        os.makedirs(args.tmp, exist_ok=True)
+
+    results = []
+    for count in args.scenes:
+        for plugin in plugins:
+            print(f"{plugin} - {count} scenes", flush=True)
+            results += benchmark(plugin, count, args)
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import argparse
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmark import DEFAULT_CONFIG, DEFAULT_PLUGIN, Library, install_plugin, run_plugin, serve
+
+# Check of the renamerOnUpdate plugin with a file used by another process (Linux).
+#
+# A scene is moved to another drive (--dest, default /dev/shm) while a process
+# has its file open. Opened for writing, the plugin must find the process in /proc
+# and not copy the file (or kill the process with process_kill_attach). Opened
+# for reading, the file is moved as usual.
+#
+# python check_busy.py --plugin ../../plugins/renamerOnUpdate
+
+HOLDER = "import sys, time\nf = open(sys.argv[1], sys.argv[2])\nprint('ready', flush=True)\ntime.sleep(120)\n"
+
+
+def hold_file(path: str, mode: str):
+    process = subprocess.Popen([sys.executable, "-c", HOLDER, path, mode], stdout=subprocess.PIPE, text=True)
+    process.stdout.readline()
+    # reaped as soon as it's killed, like Stash does for its ffmpeg
+    threading.Thread(target=process.wait, daemon=True).start()
+    return process
+
+
+def scene_path(library: Library, scene_id: int):
+    connection = sqlite3.connect(library.database)
+    path = connection.execute("SELECT path FROM scenes WHERE id=?;", [scene_id]).fetchone()[0]
+    connection.close()
+    return path
+
+
+def check(plugin: str, dest: str, mode: str, kill: bool):
+    # True if the plugin did what it should with the file held in this mode
+    root = tempfile.mkdtemp(prefix="renamer_busy_")
+    library_dir = tempfile.mkdtemp(prefix="renamer_busy_", dir=dest)
+    holder = None
+    try:
+        library = Library(root, 5, 1)
+        server = serve(library)
+        config_extra = DEFAULT_CONFIG.format(library=library_dir) + f"\nprocess_kill_attach = {kill}\n"
+        plugin_dir = install_plugin(plugin, root, config_extra)
+        path = scene_path(library, 1)
+        # the sparse file would be written in full on the other drive
+        os.truncate(path, 1024 * 1024)
+        holder = hold_file(path, mode)
+        context = {"type": "Scene.Update.Post", "id": 1, "inputFields": ["title"]}
+        _, process, _ = run_plugin(plugin_dir, server.server_address[1], {"hookContext": context})
+        server.shutdown()
+        moved = scene_path(library, 1) != path and not os.path.exists(path)
+        if kill:
+            time.sleep(0.5)
+            expected = moved and holder.poll() is not None
+        else:
+            expected = moved == (mode == "rb")
+        print(f"{'ok' if expected else 'FAILED'}: opened with '{mode}'{', process_kill_attach' if kill else ''}: {'moved' if moved else 'not moved'}")
+        if not expected:
+            print(process.stderr)
+        return expected
+    finally:
+        if holder and holder.poll() is None:
+            holder.kill()
+        shutil.rmtree(root, ignore_errors=True)
+        shutil.rmtree(library_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check of renamerOnUpdate with a file used by another process (Linux).")
+    parser.add_argument("--plugin", default=DEFAULT_PLUGIN, help="folder of the plugin to test")
+    parser.add_argument("--dest", default="/dev/shm", help="folder on another drive than the system temp")
+    args = parser.parse_args()
+    if not os.path.isdir("/proc/self/fd"):
+        sys.exit("No /proc, Linux only")
+    if os.stat(args.dest).st_dev == os.stat(tempfile.gettempdir()).st_dev:
+        sys.exit(f"{args.dest} is on the same drive as {tempfile.gettempdir()}, use --dest")
+    plugin = os.path.abspath(args.plugin)
+    results = [check(plugin, args.dest, "r+b", False), check(plugin, args.dest, "rb", False)]
+    try:
+        import psutil  # noqa: F401 (needed by process_kill_attach)
+        results.append(check(plugin, args.dest, "r+b", True))
+    except ImportError:
+        print("psutil not installed, process_kill_attach not checked")
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()